@@ -1,60 +1,746 @@
-from openai import OpenAI
-from openai import APIError, APIConnectionError
+import asyncio
+import atexit
+import email.utils
+import json
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from openai import APIConnectionError, APITimeoutError
 from zhipuai import ZhipuAI
+from zhipuai import APIConnectionError as ZhipuAPIConnectionError
+
+from llm_cache import ResponseCache, request_key, DEFAULT_CACHE_PATH
+from rate_limiter import RateLimiter, estimate_tokens, estimate_text_tokens, load_limits_from_env, DEFAULT_STATE_PATH
+from llm_stats import UsageTracker, count_images
+from adaptive_limiter import AdaptiveLimiter
+from circuit_breaker import CircuitBreaker
+
+OPENAI_MODELS = ["gpt-4.1-2025-04-14", "gpt-4.1-mini-2025-04-14", "gpt-4.1-nano-2025-04-14"]
+REQUEST_TIMEOUT = 90
+MAX_TOKENS = 2048
+
+# Retry policy. Rate-limit errors (429) have their own, larger budget so that a
+# busy endpoint does not use up the retries meant for real failures; 4xx errors
+# other than 408/409/429 are never retried because they cannot succeed.
+RATE_LIMIT_RETRIES = int(os.environ.get("CHEMTABLE_RATE_LIMIT_RETRIES", 8))
+BACKOFF_BASE = float(os.environ.get("CHEMTABLE_BACKOFF_BASE", 1.0))
+BACKOFF_MAX = float(os.environ.get("CHEMTABLE_BACKOFF_MAX", 60.0))
+RETRYABLE_STATUS = {408, 409}
+
+# Per-task generation profiles. A terminator is a regex that marks the end of the
+# answer; when set, the completion is streamed and closed as soon as it matches,
+# instead of letting the model ramble on up to max_tokens. The terminator text is
+# kept in the returned content (unlike API-side `stop` sequences).
+TASK_PROFILES = {}
+# Ask OpenAI-compatible endpoints for a usage block at the end of streamed
+# responses. A stream closed early at its terminator never reaches that block, so
+# its tokens are estimated (see rate_limiter.estimate_tokens). Set to 0 for endpoints that reject stream_options.
+STREAM_USAGE = os.environ.get("CHEMTABLE_STREAM_USAGE", "1") != "0"
+
+# Request hedging: once a request has been outstanding longer than this latency
+# percentile (measured online per model), a duplicate is sent and the first answer
+# wins. 0 disables hedging. Hedges are capped at HEDGE_BUDGET x requests overall.
+HEDGE_PERCENTILE = float(os.environ.get("CHEMTABLE_HEDGE_PERCENTILE", 0))
+HEDGE_BUDGET = float(os.environ.get("CHEMTABLE_HEDGE_BUDGET", 0.05))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 500
+
+# One client (and so one keep-alive connection pool) per (provider, endpoint, key),
+# shared by every thread in the process. The pool should be at least as large as
+# the number of worker threads, otherwise workers queue up waiting for a connection.
+POOL_SIZE = int(os.environ.get("CHEMTABLE_POOL_SIZE", 64))
+
+# In-flight requests per model are set by an AIMD controller: it starts at
+# INITIAL_CONCURRENCY, grows while latency and error rate stay healthy, and backs
+# off on 429s, timeouts and 5xx errors, up to MODEL_CONCURRENCY (or the cap set
+# with set_model_concurrency). All async requests run on a single background
+# event loop, so hundreds can be in flight without a thread per request.
+MODEL_CONCURRENCY = int(os.environ.get("CHEMTABLE_MODEL_CONCURRENCY", 256))
+INITIAL_CONCURRENCY = int(os.environ.get("CHEMTABLE_INITIAL_CONCURRENCY", 4))
 
+# Circuit breaker per endpoint: after BREAKER_FAILURES consecutive server errors,
+# timeouts or connection failures, requests to that endpoint wait (instead of
+# burning their retries) until a half-open probe succeeds. A request that has been
+# paused for BREAKER_MAX_WAIT seconds gives up with CircuitOpenError; 0 fails fast.
+BREAKER_FAILURES = int(os.environ.get("CHEMTABLE_BREAKER_FAILURES", 5))
+BREAKER_OPEN_SECONDS = float(os.environ.get("CHEMTABLE_BREAKER_OPEN_SECONDS", 30))
+BREAKER_MAX_WAIT = float(os.environ.get("CHEMTABLE_BREAKER_MAX_WAIT", 900))
 
-def call_LLM(mes, model_name="gpt-4.1-2025-04-14", temperature=0, try_limit=3):
-    url = "YOUR_OPENAI_API_ENDPOINT"
-    key = "YOUR_OPENAI_API_KEY"
-    if model_name != "gpt-4.1-2025-04-14" and model_name != "gpt-4.1-mini-2025-04-14" and model_name != "gpt-4.1-nano-2025-04-14":
-        url = "YOUR_ALTERNATIVE_API_ENDPOINT"
-        key = "YOUR_ALTERNATIVE_API_KEY"
+# Thread pool size for the (blocking) eval scripts. It is only a ceiling: the
+# controller above decides how many of these threads actually have a request in flight.
+MAX_WORKERS = int(os.environ.get("CHEMTABLE_MAX_WORKERS", 64))
 
-    if model_name == "qwen2.5-vl-72b-instruct":
-        url = "YOUR_ALTERNATIVE_API_ENDPOINT"
-        key = "YOUR_QWEN_API_KEY"
+# The image prefetcher and the dataset builder spawn worker processes, which
+# re-import the calling script and with it this module. They never call an LLM,
+# so the cache, batch mode and exit reports below are only set up in the main process.
+IN_WORKER_PROCESS = multiprocessing.current_process().name != "MainProcess"
 
-    if model_name == "intern_vl":
-        url = "YOUR_ALTERNATIVE_API_ENDPOINT"
-        key = "YOUR_QWEN_API_KEY"
+_clients = {}
+_clients_lock = threading.Lock()
+_async_clients = {}
+_model_limits = {}
+_limiters = {}
+_breakers = {}
+_loop = None
+_loop_lock = threading.Lock()
+_latencies = {}
+_inflight = {}
+_hedge_counts = {"requests": 0, "hedges": 0}
+_cache = None
+_batch_dir = None
+_batch_seen = set()
+_batch_loaded = set()
+_batch_lock = threading.Lock()
+_rate_limiter = RateLimiter(os.environ.get("CHEMTABLE_RATE_LIMIT_STATE", DEFAULT_STATE_PATH))
+load_limits_from_env(_rate_limiter)
+_usage = UsageTracker(os.environ.get("CHEMTABLE_LLM_USAGE_LOG"))
+USAGE_DIR = os.environ.get("CHEMTABLE_LLM_USAGE_DIR", "res/llm_usage")
 
+
+def get_endpoint(model_name):
     if model_name == "glm-4v-plus":
-        client = ZhipuAI(api_key="YOUR_ZHIPU_API_KEY")
-    else:
-        client = OpenAI(
-            base_url=url,
-            api_key=key,
-            timeout=90
+        return "zhipu", None, "YOUR_ZHIPU_API_KEY"
+    if model_name == "qwen2.5-vl-72b-instruct" or model_name == "intern_vl":
+        return "openai", "YOUR_ALTERNATIVE_API_ENDPOINT", "YOUR_QWEN_API_KEY"
+    if model_name in OPENAI_MODELS:
+        return "openai", "YOUR_OPENAI_API_ENDPOINT", "YOUR_OPENAI_API_KEY"
+    return "openai", "YOUR_ALTERNATIVE_API_ENDPOINT", "YOUR_ALTERNATIVE_API_KEY"
+
+
+def set_pool_size(size):
+    global POOL_SIZE
+    with _clients_lock:
+        if size == POOL_SIZE:
+            return
+        POOL_SIZE = max(int(size), 1)
+        # Clients built with the old size keep serving requests already holding them.
+        _clients.clear()
+        _async_clients.clear()
+
+
+def set_model_concurrency(model_name, limit):
+    _model_limits[model_name] = max(int(limit), 1)
+    limiter = _limiters.get(model_name)
+    if limiter is not None:
+        _get_loop().call_soon_threadsafe(limiter.set_maximum, _model_limits[model_name])
+
+
+def register_task_profile(task, max_tokens=None, stop=None, terminator=None):
+    TASK_PROFILES[task] = {
+        "max_tokens": max_tokens,
+        "stop": stop,
+        "terminator": re.compile(terminator) if terminator else None
+    }
+
+
+register_task_profile("smiles", max_tokens=512, terminator=r"</smiles>")
+register_task_profile("html", terminator=r"</table>")
+register_task_profile("qa_json", terminator=r"\}\s*```")
+register_task_profile("qa_json_packed", max_tokens=4096, terminator=r"\]\s*\}\s*```")
+register_task_profile("judge", max_tokens=512, terminator=r"\}\s*```")
+register_task_profile("repair_json", terminator=r"\}\s*```")
+register_task_profile("repair_html", terminator=r"</table>")
+
+
+def _request_params(task, max_tokens, stop):
+    profile = TASK_PROFILES.get(task, {})
+    return {
+        "max_tokens": max_tokens or profile.get("max_tokens") or MAX_TOKENS,
+        "stop": stop or profile.get("stop"),
+        "terminator": profile.get("terminator")
+    }
+
+
+def enable_hedging(percentile=95, budget=0.05):
+    global HEDGE_PERCENTILE, HEDGE_BUDGET
+    HEDGE_PERCENTILE = percentile
+    HEDGE_BUDGET = budget
+
+
+def set_rate_limit(name, rpm=None, tpm=None):
+    # `name` is an endpoint URL (shared by every model behind it) or a model name.
+    _rate_limiter.set_limit(name, rpm=rpm, tpm=tpm)
+
+
+def configure_workers(workers=None, models=()):
+    # Thread-pool size for a blocking eval script. Without an explicit count the pool
+    # is sized to MAX_WORKERS and the adaptive controller decides the real
+    # concurrency; an explicit count caps the controller for `models`.
+    if workers:
+        for model_name in models:
+            set_model_concurrency(model_name, workers)
+    size = workers or MAX_WORKERS
+    set_pool_size(size)
+    return size
+
+
+def enable_cache(path=DEFAULT_CACHE_PATH, read_only=False, max_size_mb=2048, max_age_days=None):
+    global _cache
+    _cache = ResponseCache(path, read_only=read_only, max_size_mb=max_size_mb, max_age_days=max_age_days)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def get_cache():
+    return _cache
+
+
+class LLMUnavailable(Exception):
+    """No answer is available for this request. Callers should skip the item
+    without scoring or recording it, so that a later run picks it up again."""
+
+
+class BatchPending(LLMUnavailable):
+    """Raised in batch mode when a request has been queued for the provider batch
+    API instead of being sent."""
+
+
+class TokenBudgetExceeded(LLMUnavailable):
+    """Raised once a model has used up its token budget for this run."""
+
+
+class LLMCallError(LLMUnavailable):
+    """The request failed for good: retries ran out or the error is not retryable.
+    Scripts record the item in their dead-letter queue instead of scoring it."""
+
+    def __init__(self, message, error_class, attempts):
+        super().__init__(message)
+        self.error_class = error_class
+        self.attempts = attempts
+
+
+class CircuitOpenError(LLMCallError):
+    """Raised when the model's endpoint stayed down for longer than BREAKER_MAX_WAIT."""
+
+
+def set_token_budget(model_name, tokens):
+    _usage.set_budget(model_name, tokens)
+
+
+def get_usage_summary():
+    return _usage.summary()
+
+
+def enable_batch_mode(output_dir="res/batch"):
+    # Cache misses are written to <output_dir>/requests_<model>.jsonl in the provider
+    # batch input format; batch_job.py submits them and imports the results into the
+    # response cache, after which re-running the script scores them as usual.
+    global _batch_dir
+    if _cache is None:
+        enable_cache()
+    os.makedirs(output_dir, exist_ok=True)
+    _batch_dir = output_dir
+
+
+def batch_input_path(model_name, output_dir="res/batch"):
+    return os.path.join(output_dir, f"requests_{model_name.replace('/', '_')}.jsonl")
+
+
+def _record_batch_request(cache_key, model_name, mes, temperature, params):
+    provider, url, key = get_endpoint(model_name)
+    path = batch_input_path(model_name, _batch_dir)
+    with _batch_lock:
+        if path not in _batch_loaded:
+            # Requests already queued by an earlier run of this round are not written twice.
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            _batch_seen.add(json.loads(line)["custom_id"])
+                        except (json.JSONDecodeError, KeyError):
+                            continue
+            _batch_loaded.add(path)
+        if cache_key in _batch_seen:
+            return
+        _batch_seen.add(cache_key)
+        request = {
+            "custom_id": cache_key,
+            "method": "POST",
+            "url": "/v4/chat/completions" if provider == "zhipu" else "/v1/chat/completions",
+            "body": {
+                "model": model_name,
+                "messages": mes,
+                "temperature": temperature,
+                "max_tokens": params["max_tokens"]
+            }
+        }
+        if params["stop"]:
+            request["body"]["stop"] = params["stop"]
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(request, ensure_ascii=False) + '\n')
+
+
+def _print_cache_stats():
+    if _cache is not None:
+        stats = _cache.stats()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.2%}), "
+              f"{stats['entries']} entries, {stats['size_mb']:.1f} MB")
+
+
+def _build_client(provider, url, key):
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=POOL_SIZE,
+            max_keepalive_connections=POOL_SIZE,
+            keepalive_expiry=60
+        ),
+        timeout=REQUEST_TIMEOUT
+    )
+    if provider == "zhipu":
+        return ZhipuAI(api_key=key, timeout=REQUEST_TIMEOUT, max_retries=0, http_client=http_client)
+    return OpenAI(base_url=url, api_key=key, timeout=REQUEST_TIMEOUT, max_retries=0, http_client=http_client)
+
+
+def get_client(provider, url, key):
+    client_key = (provider, url, key)
+    client = _clients.get(client_key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(client_key)
+        if client is None:
+            client = _build_client(provider, url, key)
+            _clients[client_key] = client
+    return client
+
+
+def _get_loop():
+    global _loop
+    if _loop is not None:
+        return _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def _get_async_client(provider, url, key):
+    # Only touched from the LLM event loop thread, so no lock is needed.
+    client_key = (provider, url, key)
+    client = _async_clients.get(client_key)
+    if client is None:
+        pool_size = max(POOL_SIZE, MODEL_CONCURRENCY)
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=60
+            ),
+            timeout=REQUEST_TIMEOUT
         )
-    while try_limit > 0:
+        client = AsyncOpenAI(base_url=url, api_key=key, timeout=REQUEST_TIMEOUT, max_retries=0,
+                             http_client=http_client)
+        _async_clients[client_key] = client
+    return client
+
+
+def _get_limiter(model_name):
+    limiter = _limiters.get(model_name)
+    if limiter is None:
+        limiter = AdaptiveLimiter(INITIAL_CONCURRENCY, maximum=_model_limits.get(model_name, MODEL_CONCURRENCY))
+        _limiters[model_name] = limiter
+    return limiter
+
+
+def _get_breaker(model_name):
+    provider, url, key = get_endpoint(model_name)
+    name = url or provider
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = CircuitBreaker(name, BREAKER_FAILURES, BREAKER_OPEN_SECONDS)
+        _breakers[name] = breaker
+    return breaker
+
+
+def get_endpoint_health():
+    return {name: breaker.health() for name, breaker in _breakers.items()}
+
+
+def get_concurrency(model_name):
+    limiter = _limiters.get(model_name)
+    return int(limiter.limit) if limiter is not None else None
+
+
+def _close_stream(stream):
+    close = getattr(stream, "close", None)
+    if close is None:
+        close = stream.response.close
+    return close()
+
+
+def _consume_stream_sync(stream, terminator):
+    content = ""
+    usage = None
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            content += delta
+            match = terminator.search(content, max(len(content) - len(delta) - 64, 0))
+            if match:
+                content = content[:match.end()]
+                break
+    finally:
+        _close_stream(stream)
+    return content, usage
+
+
+async def _create_completion(mes, model_name, temperature, params):
+    provider, url, key = get_endpoint(model_name)
+    kwargs = {
+        "model": model_name,
+        "messages": mes,
+        "temperature": temperature,
+        "max_tokens": params["max_tokens"]
+    }
+    if params["stop"]:
+        kwargs["stop"] = params["stop"]
+    terminator = params["terminator"]
+    if provider == "zhipu":
+        # The Zhipu SDK has no asyncio client; run the pooled sync client off-loop.
+        client = get_client(provider, url, key)
+        if terminator is None:
+            response = await asyncio.to_thread(client.chat.completions.create, **kwargs)
+            return response.choices[0].message.content, response.usage
+        stream = await asyncio.to_thread(client.chat.completions.create, stream=True, **kwargs)
+        return await asyncio.to_thread(_consume_stream_sync, stream, terminator)
+    client = _get_async_client(provider, url, key)
+    if terminator is None:
+        response = await client.chat.completions.create(**kwargs)
+        return response.choices[0].message.content, response.usage
+    if STREAM_USAGE:
+        kwargs["stream_options"] = {"include_usage": True}
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    content = ""
+    usage = None
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            content += delta
+            match = terminator.search(content, max(len(content) - len(delta) - 64, 0))
+            if match:
+                content = content[:match.end()]
+                break
+    finally:
+        await _close_stream(stream)
+    return content, usage
+
+
+def _quota_names(model_name):
+    provider, url, key = get_endpoint(model_name)
+    return [url or provider, model_name]
+
+
+async def _wait_for_quota(names, tokens):
+    while True:
+        wait = await asyncio.to_thread(_rate_limiter.try_acquire, names, tokens)
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+
+def _record_latency(model_name, latency):
+    window = _latencies.get(model_name)
+    if window is None:
+        window = _latencies[model_name] = deque(maxlen=LATENCY_WINDOW)
+    window.append(latency)
+
+
+def _hedge_delay(model_name):
+    window = _latencies.get(model_name)
+    if not HEDGE_PERCENTILE or window is None or len(window) < HEDGE_MIN_SAMPLES:
+        return None
+    samples = sorted(window)
+    return samples[min(int(len(samples) * HEDGE_PERCENTILE / 100), len(samples) - 1)]
+
+
+async def _take_hedge(quota_names, tokens):
+    if _hedge_counts["hedges"] + 1 > HEDGE_BUDGET * _hedge_counts["requests"]:
+        return False
+    # A hedge never waits for quota; if the bucket is empty the primary is awaited.
+    if await asyncio.to_thread(_rate_limiter.try_acquire, quota_names, tokens) > 0:
+        return False
+    _hedge_counts["hedges"] += 1
+    return True
+
+
+async def _send(mes, model_name, temperature, params, quota_names, tokens, dispatched=None):
+    limiter = _get_limiter(model_name)
+    breaker = _get_breaker(model_name)
+    await limiter.acquire()
+    if dispatched is not None:
+        dispatched.set()
+    outcome = "cancelled"
+    latency = None
+    try:
+        start = time.monotonic()
+        content, usage = await _create_completion(mes, model_name, temperature, params)
+        latency = time.monotonic() - start
+        outcome = "ok"
+        _record_latency(model_name, latency)
+    except Exception as e:
+        outcome = classify_error(e)[0]
+        raise
+    finally:
+        limiter.release(outcome, latency)
+        breaker.record(outcome)
+    if usage is not None and getattr(usage, "total_tokens", None):
+        correction = usage.total_tokens - tokens
+    else:
+        # `tokens` reserved the prompt estimate plus the full max_tokens; without a
+        # usage block, give back what the (often terminated) answer did not use.
+        correction = estimate_text_tokens(content or "") - params["max_tokens"]
+    await asyncio.to_thread(_rate_limiter.adjust, quota_names, correction)
+    return content, usage
+
+
+async def _send_hedged(mes, model_name, temperature, params, quota_names, tokens):
+    await _wait_for_quota(quota_names, tokens)
+    _hedge_counts["requests"] += 1
+    delay = _hedge_delay(model_name)
+    if delay is None:
+        return await _send(mes, model_name, temperature, params, quota_names, tokens)
+    dispatched = asyncio.Event()
+    tasks = [asyncio.ensure_future(_send(mes, model_name, temperature, params, quota_names, tokens, dispatched))]
+    dispatch_wait = asyncio.ensure_future(dispatched.wait())
+    try:
+        # The hedge clock starts once the primary holds a concurrency slot: time
+        # spent queued for one says nothing about a slow endpoint.
+        await asyncio.wait([tasks[0], dispatch_wait], return_when=asyncio.FIRST_COMPLETED)
+        done = tasks[0].done()
+        if not done:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+        if not done and await _take_hedge(quota_names, tokens):
+            tasks.append(asyncio.ensure_future(_send(mes, model_name, temperature, params, quota_names, tokens)))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        # Every copy failed; surface the primary's error to the retry loop.
+        return tasks[0].result()
+    finally:
+        dispatch_wait.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+def _parse_retry_after(response):
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(e):
+    """Return (kind, retry_after) where kind is one of rate_limit, server, timeout,
+    connection, client or unexpected."""
+    status = getattr(e, "status_code", None)
+    response = getattr(e, "response", None)
+    if status is None and isinstance(response, httpx.Response):
+        status = response.status_code
+    if status is not None:
+        retry_after = _parse_retry_after(response if isinstance(response, httpx.Response) else None)
+        if status == 429:
+            return "rate_limit", retry_after
+        if status >= 500 or status in RETRYABLE_STATUS:
+            return "server", retry_after
+        return "client", None
+    if isinstance(e, (APITimeoutError, httpx.TimeoutException)) or "Timeout" in type(e).__name__:
+        return "timeout", None
+    if isinstance(e, (APIConnectionError, ZhipuAPIConnectionError, httpx.TransportError)):
+        return "connection", None
+    return "unexpected", None
+
+
+def _backoff_delay(attempt, retry_after=None):
+    # Full jitter keeps many workers that failed together from retrying together.
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        # Honour Retry-After, but a large or bogus value must not park a worker for hours.
+        delay = min(retry_after, BACKOFF_MAX) + random.uniform(0, BACKOFF_BASE)
+    return delay
+
+
+def _prepare_request(mes, model_name, temperature, task, max_tokens, stop):
+    """Generation parameters, cache fingerprint and prompt token estimate of a
+    request. Hashing and estimating multi-MB image messages is CPU work, so this
+    runs in the calling thread rather than on the shared event loop."""
+    params = _request_params(task, max_tokens, stop)
+    fingerprint = request_key(model_name, mes, temperature, params["max_tokens"], params["stop"])
+    return params, fingerprint, estimate_tokens(mes)
+
+
+async def _acall_LLM(mes, model_name, temperature, try_limit, task, params, fingerprint, prompt_tokens):
+    start = time.time()
+    cache = _cache
+    if cache is not None:
+        # SQLite can block on locks held by other processes; keep it off the loop.
+        cached = await asyncio.to_thread(cache.get, fingerprint)
+        if cached is not None:
+            _usage.record(model_name, task, start, time.time(), cached=True)
+            return cached
+        if _batch_dir is not None:
+            await asyncio.to_thread(_record_batch_request, fingerprint, model_name, mes, temperature, params)
+            raise BatchPending(f"Request for {model_name} queued for batch submission")
+        if cache.read_only:
+            raise LLMCallError(f"Cache miss in read-only mode for {model_name}", "cache_miss", 0)
+
+    # Identical requests already in flight share one HTTP call and its result.
+    leader = _inflight.get(fingerprint)
+    if leader is not None:
+        content = await asyncio.shield(leader)
+        _usage.record(model_name, task, start, time.time(), coalesced=True)
+        return content
+    leader = asyncio.get_running_loop().create_future()
+    _inflight[fingerprint] = leader
+    try:
+        content = await _call_with_retries(mes, model_name, temperature, try_limit, task, params, prompt_tokens,
+                                           start)
+        leader.set_result(content)
+    except asyncio.CancelledError:
+        leader.cancel()
+        raise
+    except Exception as e:
+        leader.set_exception(e)
+        # Mark the exception as retrieved so it is not logged when nobody else waited.
+        leader.exception()
+        raise
+    finally:
+        _inflight.pop(fingerprint, None)
+    if cache is not None and content is not None:
+        await asyncio.to_thread(cache.put, fingerprint, model_name, content)
+    return content
+
+
+async def _call_with_retries(mes, model_name, temperature, try_limit, task, params, prompt_tokens, start):
+    if _usage.over_budget(model_name):
+        raise TokenBudgetExceeded(f"Token budget for {model_name} is used up")
+    rate_limit_retries = RATE_LIMIT_RETRIES
+    attempt = 0
+    quota_names = _quota_names(model_name)
+    tokens = prompt_tokens + params["max_tokens"]
+    images = count_images(mes)
+    breaker = _get_breaker(model_name)
+    while True:
+        if not await breaker.wait_ready(BREAKER_MAX_WAIT):
+            _usage.record(model_name, task, start, time.time(), images=images, retries=attempt, error="circuit_open")
+            raise CircuitOpenError(f"Endpoint {breaker.name} for {model_name} is down", "circuit_open", attempt)
         try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=mes,
-                temperature=temperature,
-                max_tokens=2048
-            )
-            return response.choices[0].message.content
-        except (APIError, APIConnectionError) as e:
-            print(f"API Error: {e}")
-            try_limit -= 1
+            content, usage = await _send_hedged(mes, model_name, temperature, params, quota_names, tokens)
+            if usage is not None:
+                _usage.record(model_name, task, start, time.time(), usage.prompt_tokens, usage.completion_tokens,
+                              images, attempt)
+            else:
+                # Streams closed at their terminator (and some endpoints) carry no usage block;
+                # fall back to estimates, which are reported and priced apart.
+                _usage.record(model_name, task, start, time.time(), prompt_tokens,
+                              estimate_text_tokens(content or ""), images, attempt, estimated=True)
+            return content
         except Exception as e:
-            print(f"Unexpected error: {e}")
-            try_limit -= 1
-    return "Error!!!"
+            last_error = e
+            kind, retry_after = classify_error(e)
+            if kind == "unexpected":
+                print(f"Unexpected error: {e}")
+            else:
+                print(f"API Error ({kind}): {e}")
+            if kind == "client":
+                break
+            if kind == "rate_limit":
+                rate_limit_retries -= 1
+                if rate_limit_retries <= 0:
+                    break
+            else:
+                try_limit -= 1
+                if try_limit <= 0:
+                    break
+            # Sleep outside the limiter so the slot is free for other requests.
+            await asyncio.sleep(_backoff_delay(attempt, retry_after))
+            attempt += 1
+    _usage.record(model_name, task, start, time.time(), images=images, retries=attempt, error=kind)
+    raise LLMCallError(f"Request to {model_name} failed after {attempt + 1} attempts: {last_error}", kind, attempt + 1)
+
+
+async def acall_LLM(mes, model_name="gpt-4.1-2025-04-14", temperature=0, try_limit=3, task=None, max_tokens=None,
+                    stop=None):
+    loop = _get_loop()
+    prepared = await asyncio.to_thread(_prepare_request, mes, model_name, temperature, task, max_tokens, stop)
+    coro = _acall_LLM(mes, model_name, temperature, try_limit, task, *prepared)
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    # Requests from any other event loop are forwarded to the shared LLM loop so
+    # that clients, connection pools and concurrency limits are shared process-wide.
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def call_LLM(mes, model_name="gpt-4.1-2025-04-14", temperature=0, try_limit=3, task=None, max_tokens=None, stop=None):
+    prepared = _prepare_request(mes, model_name, temperature, task, max_tokens, stop)
+    coro = _acall_LLM(mes, model_name, temperature, try_limit, task, *prepared)
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
 
 
 def call_qwen_llm(mes, model_name="qwen2.5-vl-7b-instruct", temperature=0, try_limit=3):
-    url = "YOUR_ALTERNATIVE_API_ENDPOINT"
-    key = "YOUR_QWEN_API_KEY"
-    client = OpenAI(
-        api_key=key,
-        base_url=url,
-    )
+    client = get_client("openai", "YOUR_ALTERNATIVE_API_ENDPOINT", "YOUR_QWEN_API_KEY")
     completion = client.chat.completions.create(
         model=model_name,
         messages=mes,
         temperature=temperature,
-        max_tokens=2048
+        max_tokens=MAX_TOKENS
     )
     return completion.choices[0].message.content
+
+
+if not IN_WORKER_PROCESS:
+    # Opt-in persistent response cache, e.g. CHEMTABLE_LLM_CACHE=1 (default path) or a
+    # path to an SQLite file. CHEMTABLE_LLM_CACHE_MODE=readonly serves hits only and
+    # never calls the API, for deterministic re-scoring of an earlier run.
+    if os.environ.get("CHEMTABLE_LLM_CACHE"):
+        _cache_path = os.environ["CHEMTABLE_LLM_CACHE"]
+        enable_cache(
+            DEFAULT_CACHE_PATH if _cache_path == "1" else _cache_path,
+            read_only=os.environ.get("CHEMTABLE_LLM_CACHE_MODE", "readwrite") == "readonly",
+            max_size_mb=float(os.environ.get("CHEMTABLE_LLM_CACHE_MAX_MB", 2048)),
+            max_age_days=float(os.environ["CHEMTABLE_LLM_CACHE_MAX_AGE_DAYS"]) if os.environ.get("CHEMTABLE_LLM_CACHE_MAX_AGE_DAYS") else None
+        )
+    if os.environ.get("CHEMTABLE_LLM_MODE") == "batch":
+        enable_batch_mode(os.environ.get("CHEMTABLE_BATCH_DIR", "res/batch"))
+    # Per-model token budgets, e.g. CHEMTABLE_TOKEN_BUDGETS='{"gpt-4.1-2025-04-14": 5000000}'
+    if os.environ.get("CHEMTABLE_TOKEN_BUDGETS"):
+        for _model_name, _tokens in json.loads(os.environ["CHEMTABLE_TOKEN_BUDGETS"]).items():
+            set_token_budget(_model_name, _tokens)
+    atexit.register(_print_cache_stats)
+    atexit.register(lambda: _usage.write_summary(USAGE_DIR))
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import deque
+
+# Outcomes that mean the endpoint is overloaded and concurrency should back off.
+OVERLOAD_OUTCOMES = {"rate_limit", "timeout", "server"}
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for one model, used from a single event loop.
+
+    Every successful request with healthy latency that was released while the
+    limit was fully used raises the limit by 1/limit (about +1 per round of
+    requests); when callers cap concurrency below the limit, it stays put. Overload signals (429, timeouts, 5xx) halve
+    it, at most once per cooldown so that one burst of failures counts once.
+    Latency is healthy while the short-term average stays below
+    `latency_tolerance` times the long-term average; when it rises past that,
+    the limit shrinks gently instead of growing."""
+
+    def __init__(self, initial=4, minimum=1, maximum=256, latency_tolerance=1.5, cooldown=5.0):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self._last_decrease = 0.0
+        self._waiters = deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # Woken by _wake() but cancelled before running: pass the slot on.
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self, outcome="ok", latency=None):
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        now = time.monotonic()
+        if outcome == "ok" and latency is not None:
+            if self.short_latency is None:
+                self.short_latency = self.long_latency = latency
+            self.short_latency = 0.3 * latency + 0.7 * self.short_latency
+            self.long_latency = 0.02 * latency + 0.98 * self.long_latency
+            if self.short_latency <= self.latency_tolerance * self.long_latency:
+                if saturated:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif now - self._last_decrease > self.cooldown:
+                self.limit = max(self.minimum, self.limit * 0.9)
+                self._last_decrease = now
+        elif outcome in OVERLOAD_OUTCOMES and now - self._last_decrease > self.cooldown:
+            self.limit = max(self.minimum, self.limit * 0.5)
+            self._last_decrease = now
+        self._wake()
+
+    def set_maximum(self, maximum):
+        self.maximum = max(int(maximum), self.minimum)
+        self.limit = min(self.limit, self.maximum)
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
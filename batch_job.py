@@ -0,0 +1,135 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+
+from LLM import get_client, get_endpoint, enable_cache
+from llm_cache import DEFAULT_CACHE_PATH
+
+# Offline batch workflow for any eval script:
+#   1. CHEMTABLE_LLM_MODE=batch python eval/TR_eval.py   -> res/batch/requests_<model>.jsonl
+#   2. python batch_job.py submit                        -> one provider batch job per model
+#   3. python batch_job.py fetch                         -> finished outputs go into the LLM cache
+#   4. re-run step 1; cached answers are scored and written as usual, and any
+#      follow-up calls (e.g. answer judging) are queued for the next round.
+# `python batch_job.py import --output <file>` loads a batch output file produced
+# elsewhere (or by a local stand-in) instead of step 3.
+
+BATCH_DIR = "res/batch"
+
+
+def load_jobs(batch_dir):
+    jobs_file = os.path.join(batch_dir, "jobs.json")
+    if not os.path.exists(jobs_file):
+        return []
+    with open(jobs_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_jobs(jobs, batch_dir):
+    with open(os.path.join(batch_dir, "jobs.json"), 'w', encoding='utf-8') as f:
+        json.dump(jobs, f, ensure_ascii=False, indent=2)
+
+
+def read_model_name(input_file):
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                return json.loads(line)["body"]["model"]
+    return None
+
+
+def submit(batch_dir):
+    jobs = load_jobs(batch_dir)
+    submitted_dir = os.path.join(batch_dir, "submitted")
+    os.makedirs(submitted_dir, exist_ok=True)
+    for input_file in sorted(glob.glob(os.path.join(batch_dir, "requests_*.jsonl"))):
+        model_name = read_model_name(input_file)
+        if model_name is None:
+            continue
+        provider, url, key = get_endpoint(model_name)
+        client = get_client(provider, url, key)
+        with open(input_file, 'rb') as f:
+            uploaded = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v4/chat/completions" if provider == "zhipu" else "/v1/chat/completions",
+            completion_window="24h"
+        )
+        # Move the input away so the next collection round starts a fresh file.
+        archived = os.path.join(submitted_dir, f"{batch.id}.jsonl")
+        shutil.move(input_file, archived)
+        jobs.append({"batch_id": batch.id, "model": model_name, "input_file": archived, "status": batch.status})
+        print(f"Submitted {archived} for {model_name} as batch {batch.id}")
+    save_jobs(jobs, batch_dir)
+
+
+def import_output(lines, cache, model_name=None):
+    imported = 0
+    failed = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        body = response.get("body") or {}
+        if item.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+            failed += 1
+            continue
+        content = body["choices"][0]["message"]["content"]
+        if content is None:
+            failed += 1
+            continue
+        cache.put(item["custom_id"], body.get("model", model_name), content)
+        imported += 1
+    return imported, failed
+
+
+def fetch(batch_dir, cache):
+    jobs = load_jobs(batch_dir)
+    for job in jobs:
+        if job["status"] in ("imported", "failed", "expired", "cancelled"):
+            continue
+        client = get_client(*get_endpoint(job["model"]))
+        batch = client.batches.retrieve(job["batch_id"])
+        job["status"] = batch.status
+        if batch.status != "completed":
+            print(f"Batch {job['batch_id']} ({job['model']}): {batch.status}")
+            continue
+        content = client.files.content(batch.output_file_id).content.decode("utf-8")
+        output_file = os.path.join(batch_dir, "submitted", f"{job['batch_id']}_output.jsonl")
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        imported, failed = import_output(content.splitlines(), cache, job["model"])
+        job["status"] = "imported"
+        print(f"Batch {job['batch_id']} ({job['model']}): imported {imported}, failed {failed}")
+    save_jobs(jobs, batch_dir)
+
+
+def status(batch_dir):
+    for job in load_jobs(batch_dir):
+        print(f"{job['batch_id']}  {job['model']:<30} {job['status']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run LLM requests collected in batch mode through provider batch APIs')
+    parser.add_argument('command', choices=['submit', 'fetch', 'status', 'import'])
+    parser.add_argument('--batch_dir', default=BATCH_DIR, help='Directory with collected batch requests')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH, help='LLM response cache to import results into')
+    parser.add_argument('--output', nargs='+', default=[], help='Batch output files for the import command')
+    args = parser.parse_args()
+
+    os.makedirs(args.batch_dir, exist_ok=True)
+    if args.command == 'submit':
+        submit(args.batch_dir)
+    elif args.command == 'status':
+        status(args.batch_dir)
+    elif args.command == 'fetch':
+        fetch(args.batch_dir, enable_cache(args.cache))
+    else:
+        cache = enable_cache(args.cache)
+        for output_file in args.output:
+            with open(output_file, 'r', encoding='utf-8') as f:
+                imported, failed = import_output(f, cache)
+            print(f"{output_file}: imported {imported}, failed {failed}")
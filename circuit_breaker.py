@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+# Outcomes that say the endpoint itself is unhealthy. Any HTTP answer, even a 429
+# or a 400, proves the endpoint is up.
+FAILURE_OUTCOMES = {"server", "timeout", "connection"}
+
+
+class CircuitBreaker:
+    """Health tracking for one endpoint, used from a single event loop.
+
+    closed: requests go through. After `failure_threshold` consecutive failures
+    the circuit opens and requests wait instead of being sent. Once the open
+    period is over, a single half-open probe is let through: success closes the
+    circuit, failure re-opens it with a doubled open period (up to
+    `max_open_seconds`)."""
+
+    def __init__(self, name, failure_threshold=5, open_seconds=30, max_open_seconds=300):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.total_failures = 0
+        self.total_successes = 0
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self._changed = None
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def wait_ready(self, max_wait):
+        """Wait until a request may be sent. Returns False if the circuit stayed
+        open for longer than `max_wait` seconds."""
+        deadline = time.monotonic() + max_wait
+        while True:
+            now = time.monotonic()
+            if self.state == "closed":
+                return True
+            if self.state == "open" and now >= self.open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            if now >= deadline:
+                return False
+            wake_at = self.open_until if self.state == "open" else deadline
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=max(min(wake_at, deadline) - now, 0.01))
+            except asyncio.TimeoutError:
+                pass
+
+    def record(self, outcome):
+        if outcome == "cancelled":
+            if self.state == "half_open":
+                self.probe_in_flight = False
+                self._notify()
+            return
+        if outcome in FAILURE_OUTCOMES:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == "half_open":
+                self.open_seconds = min(self.open_seconds * 2, self.max_open_seconds)
+                self._open()
+            elif self.state == "closed" and self.failures >= self.failure_threshold:
+                self._open()
+            return
+        self.total_successes += 1
+        self.failures = 0
+        if self.state != "closed":
+            print(f"Endpoint {self.name} recovered, resuming requests")
+            self.state = "closed"
+            self.open_seconds = self.base_open_seconds
+            self.probe_in_flight = False
+            self._notify()
+
+    def _open(self):
+        self.state = "open"
+        self.probe_in_flight = False
+        self.open_until = time.monotonic() + self.open_seconds
+        print(f"Endpoint {self.name} looks down after {self.failures} consecutive failures, "
+              f"pausing requests for {self.open_seconds:.0f}s")
+        self._notify()
+
+    def health(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "failures": self.total_failures,
+            "successes": self.total_successes
+        }
@@ -1,90 +1,288 @@
-import os
+import argparse
 import json
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import get_first_number_form_str, create_dict_from_files, convert_tables_to_html, remove_special_formats, load_json_file
+
+# Built items are stored in a compiled cache (SQLite, one pickled item per table)
+# and reused until their JSON file changes (mtime or size) or their images are
+# added or removed. CHEMTABLE_DATASET_CACHE sets the file; "0" disables it.
+DATASET_CACHE_PATH = os.environ.get("CHEMTABLE_DATASET_CACHE", "cache/dataset.sqlite")
+# Items built per process-pool round in compile(), which bounds its memory use.
+COMPILE_CHUNK = 256
+# Bump when build_item changes what it produces.
+DATASET_CACHE_VERSION = 2
+
+
+def build_item(i, dicts):
+    """Build the item of table `i` from its files in `dicts` (folder -> id -> paths)."""
+    data = load_json_file(dicts["json"][i][0])
+    smiles_list = []
+    reaction_list = data["data"]["reactions"]
+    table_list = data["data"]["tables"]
+    substance_list = data["data"]["substances"]
+
+    title_list = data["data"].get("title", [])
+    title_text_list = [remove_special_formats(title_item["text"]) for title_item in title_list] if title_list else []
+    
+    annotations_list = data["data"].get("annotations", [])
+    annotations_text_list = [remove_special_formats(anno_item["text"]) for anno_item in annotations_list] if annotations_list else []
+
+    # part id -> molecule crop, from the sub_img listing ("<part id>.png")
+    sub_imgs = {}
+    for path in dicts["sub_img"].get(i, ()):
+        name, ext = os.path.splitext(os.path.basename(path))
+        if ext == ".png":
+            sub_imgs[name] = path
+
+    for reaction in reaction_list:
+        for part in reaction["reactants"] + reaction["conditions"] + reaction["products"]:
+            sub_image_path = sub_imgs.get(part["id"])
+            if sub_image_path and part.get("maps"):
+                if len(part["maps"]) > 1:
+                    continue
+                smiles_gt = part["maps"][0]["smiles"]
+                if smiles_gt == "":
+                    continue
+                smiles_list.append({
+                    "smiles_id": part["id"],
+                    "smiles_image_path": sub_image_path,
+                    "smiles_gt": smiles_gt
+                })
+    for cells in table_list[0]["data"]:
+        if len(cells["maps"]) != 0:
+            sub_image_path = sub_imgs.get(cells["id"])
+            if sub_image_path:
+                smiles_gt = cells["maps"][0]["smiles"]
+                if smiles_gt == "":
+                    continue
+                smiles_list.append({
+                    "smiles_id": cells["id"],
+                    "smiles_image_path": sub_image_path,
+                    "smiles_gt": smiles_gt
+                })
+    for substance in substance_list:
+        if len(substance["maps"]) != 0:
+            sub_image_path = sub_imgs.get(substance["id"])
+            if sub_image_path:
+                smiles_gt = substance["maps"][0]["smiles"]
+                if smiles_gt == "":
+                    continue
+                smiles_list.append({
+                    "smiles_id": substance["id"],
+                    "smiles_image_path": sub_image_path,
+                    "smiles_gt": smiles_gt
+                })
+    html_list = convert_tables_to_html(data)
+    
+    item_json = {
+        "id": i,
+        "clear_table_html": html_list[0],
+        "image_path": dicts["img"][i][0],
+        "smiles": smiles_list,
+        "title": title_text_list,
+        "annotations": annotations_text_list,
+        "reaction_list": reaction_list,
+    }
+    return item_json
+
+
+def _build_job(job):
+    return build_item(*job)
 
-from utils import get_first_number_form_str, create_dict_from_files, convert_json_tables_to_html, remove_special_formats
 
 class ChemTableDataset:
-    def __init__(self, item_len=500000, source_path="data/"):
+    """Tables of the benchmark, built on demand.
+
+    Construction only lists the data folders; an item (parsed JSON, HTML table,
+    SMILES records) is built the first time it is accessed, and the most recent
+    `cache_size` items are kept. Items are addressed by position
+    (`dataset[0]`, iteration) or by table id (`dataset.get(id)`).
+
+    Built items are also pickled into the SQLite file `compiled_path` as they are
+    built and read back one table at a time, so later runs only unpickle the
+    items they use; `compile()` builds all of them at once.
+    With `workers` > 1, `compile()`, `getDataList()` and slices build the
+    missing items in that many processes."""
+
+    def __init__(self, item_len=500000, source_path="data/", cache_size=256, compiled_path=DATASET_CACHE_PATH,
+                 workers=None):
         folders = ["json", "img", "sub_img"]
-        dicts = {}
+        self.source_path = source_path
+        self.dicts = {}
         for folder in folders:
             files = os.listdir(os.path.join(source_path, folder))
-            dicts[folder] = create_dict_from_files(files, source_path, folder)
-
-        self.data_list = []
-        available_ids = sorted(dicts["json"].keys())
-        item_ids = available_ids[:item_len] if len(available_ids) > item_len else available_ids
-        
-        for i in item_ids:
-            with open(dicts["json"][i][0], 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            smiles_list = []
-            current_sub_imgs = []
-            reaction_list = data["data"]["reactions"]
-            table_list = data["data"]["tables"]
-            substance_list = data["data"]["substances"]
-
-            title_list = data["data"].get("title", [])
-            title_text_list = [remove_special_formats(title_item["text"]) for title_item in title_list] if title_list else []
-            
-            annotations_list = data["data"].get("annotations", [])
-            annotations_text_list = [remove_special_formats(anno_item["text"]) for anno_item in annotations_list] if annotations_list else []
-
-            if i in dicts["sub_img"]:
-                current_sub_imgs = dicts["sub_img"][i]
-            for reaction in reaction_list:
-                if i not in dicts.get("sub_img", {}):
-                    continue
+            self.dicts[folder] = create_dict_from_files(files, source_path, folder)
+
+        available_ids = sorted(self.dicts["json"].keys())
+        self.ids = available_ids[:item_len] if len(available_ids) > item_len else available_ids
+        self._id_set = set(self.ids)
+        self.cache_size = cache_size
+        self.workers = workers
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
 
-                for part in reaction["reactants"] + reaction["conditions"] + reaction["products"]:
-                    sub_image_path = f"{source_path}sub_img\\{part['id']}.png"
-                    if sub_image_path in current_sub_imgs and part.get("maps"):
-                        if len(part["maps"]) > 1:
-                            continue
-                        smiles_gt = part["maps"][0]["smiles"]
-                        if smiles_gt == "":
-                            continue
-                        smiles_list.append({
-                            "smiles_id": part["id"],
-                            "smiles_image_path": sub_image_path,
-                            "smiles_gt": smiles_gt
-                        })
-            for cells in table_list[0]["data"]:
-                if len(cells["maps"]) != 0:
-                    sub_image_path = f"{source_path}sub_img\\{cells['id']}.png"
-                    if sub_image_path in current_sub_imgs:
-                        smiles_gt = cells["maps"][0]["smiles"]
-                        if smiles_gt == "":
-                            continue
-                        smiles_list.append({
-                            "smiles_id": cells["id"],
-                            "smiles_image_path": sub_image_path,
-                            "smiles_gt": smiles_gt
-                        })
-            for substance in substance_list:
-                if len(substance["maps"]) != 0:
-                    sub_image_path = f"{source_path}sub_img\\{substance['id']}.png"
-                    if sub_image_path in current_sub_imgs:
-                        smiles_gt = substance["maps"][0]["smiles"]
-                        if smiles_gt == "":
-                            continue
-                        smiles_list.append({
-                            "smiles_id": substance["id"],
-                            "smiles_image_path": sub_image_path,
-                            "smiles_gt": smiles_gt
-                        })
-            html_list = convert_json_tables_to_html(dicts["json"][i][0])
-            
-            item_json = {
-                "id": i,
-                "clear_table_html": html_list[0],
-                "image_path": dicts["img"][i][0],
-                "smiles": smiles_list,
-                "title": title_text_list,
-                "annotations": annotations_text_list,
-                "reaction_list": reaction_list,
-            }
-            self.data_list.append(item_json)
+        self.compiled_path = compiled_path if compiled_path not in (None, "", "0") else None
+        self._source_key = os.path.abspath(source_path)
+        self._conn = None
+        self._db_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._get_many(self.ids[index])
+        return self.get(self.ids[index])
+
+    def __iter__(self):
+        for i in self.ids:
+            yield self.get(i)
+
+    def __contains__(self, item_id):
+        return item_id in self._id_set
+
+    def get(self, item_id, default=None):
+        """The item of table `item_id`, or `default` if there is no such table."""
+        if item_id not in self._id_set:
+            return default
+        with self._lock:
+            item = self._cache.get(item_id)
+            if item is not None:
+                self._cache.move_to_end(item_id)
+                return item
+        item = self._load_compiled(item_id)
+        if item is None:
+            item = self._build_item(item_id)
+            self._store_compiled([(item_id, item)])
+        with self._lock:
+            self._cache[item_id] = item
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return item
+
+    def table_html(self, table, default=""):
+        """HTML of a table given by id or by image file name ("12.png")."""
+        item_id = get_first_number_form_str(table) if isinstance(table, str) else table
+        item = self.get(item_id)
+        return item["clear_table_html"] if item is not None else default
+
+    def _signature(self, i):
+        stat = os.stat(self.dicts["json"][i][0])
+        return json.dumps([
+            stat.st_mtime_ns,
+            stat.st_size,
+            self.dicts["img"].get(i, []),
+            sorted(self.dicts["sub_img"].get(i, []))
+        ])
+
+    def _query(self, sql, params=()):
+        """Run `sql` on the compiled cache; None if it is disabled or unusable."""
+        with self._db_lock:
+            if self.compiled_path is None:
+                return None
+            try:
+                if self._conn is None:
+                    if os.path.dirname(self.compiled_path):
+                        os.makedirs(os.path.dirname(self.compiled_path), exist_ok=True)
+                    conn = sqlite3.connect(self.compiled_path, timeout=30, check_same_thread=False,
+                                           isolation_level=None)
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS items (source TEXT, id INTEGER, version INTEGER, "
+                        "signature TEXT, item BLOB, PRIMARY KEY (source, id))"
+                    )
+                    self._conn = conn
+                if isinstance(params, list):
+                    self._conn.executemany(sql, params)
+                    return []
+                return self._conn.execute(sql, params).fetchall()
+            except sqlite3.DatabaseError as e:
+                print(f"Ignoring unusable dataset cache {self.compiled_path}: {e}")
+                self.compiled_path = None
+                return None
+
+    def _compiled_ids(self, item_ids):
+        """The ids in `item_ids` whose compiled entry is up to date."""
+        rows = self._query("SELECT id, signature FROM items WHERE source = ? AND version = ?",
+                           (self._source_key, DATASET_CACHE_VERSION))
+        signatures = dict(rows or [])
+        return {i for i in item_ids if i in signatures and signatures[i] == self._signature(i)}
+
+    def _load_compiled(self, item_id):
+        rows = self._query("SELECT signature, item FROM items WHERE source = ? AND id = ? AND version = ?",
+                           (self._source_key, item_id, DATASET_CACHE_VERSION))
+        if not rows or rows[0][0] != self._signature(item_id):
+            return None
+        return pickle.loads(rows[0][1])
+
+    def _store_compiled(self, items):
+        """Write `items`, (id, item) pairs, to the compiled cache."""
+        if self.compiled_path is None or not items:
+            return
+        self._query(
+            "INSERT OR REPLACE INTO items (source, id, version, signature, item) VALUES (?, ?, ?, ?, ?)",
+            [(self._source_key, i, DATASET_CACHE_VERSION, self._signature(i),
+              pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)) for i, item in items]
+        )
+
+    def compile(self):
+        """Build every item that is missing or stale in the compiled cache and
+        save it. Returns the number of items built."""
+        compiled = self._compiled_ids(self.ids)
+        missing = [i for i in self.ids if i not in compiled]
+        for start in range(0, len(missing), COMPILE_CHUNK):
+            chunk = missing[start:start + COMPILE_CHUNK]
+            self._store_compiled(list(zip(chunk, self._build_many(chunk))))
+        return len(missing)
+
+    def _files(self, i):
+        return {folder: {i: paths[i]} if i in paths else {} for folder, paths in self.dicts.items()}
+
+    def _build_item(self, i):
+        return build_item(i, self._files(i))
+
+    def _build_many(self, item_ids):
+        """Build `item_ids`, in a process pool when `workers` > 1; results come
+        back in the order of `item_ids`."""
+        if not self.workers or self.workers <= 1 or len(item_ids) <= 1:
+            return [self._build_item(i) for i in item_ids]
+        jobs = [(i, self._files(i)) for i in item_ids]
+        chunksize = max(1, len(jobs) // (self.workers * 4))
+        # Spawned rather than forked: the parent may already run the LLM event
+        # loop and worker threads.
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            return list(executor.map(_build_job, jobs, chunksize=chunksize))
+
+    def _get_many(self, item_ids):
+        with self._lock:
+            cached = set(self._cache)
+        compiled = self._compiled_ids(item_ids)
+        missing = [i for i in item_ids if i not in cached and i not in compiled]
+        built = dict(zip(missing, self._build_many(missing)))
+        self._store_compiled(list(built.items()))
+        return [built[i] if i in built else self.get(i) for i in item_ids]
 
     def getDataList(self):
-        return self.data_list
+        """All items as a list; builds every item, so prefer indexing or `get`
+        when only some tables are needed."""
+        return self._get_many(self.ids)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the dataset into the cache used by ChemTableDataset')
+    parser.add_argument('--source', default="data/", help='Dataset directory (with json/, img/ and sub_img/)')
+    parser.add_argument('--output', default=DATASET_CACHE_PATH, help='Compiled cache file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes (default: CPU count)')
+    args = parser.parse_args()
+
+    dataset = ChemTableDataset(source_path=args.source, compiled_path=args.output, workers=args.workers)
+    built = dataset.compile()
+    print(f"Compiled {len(dataset)} tables into {args.output} ({built} rebuilt, {len(dataset) - built} up to date)")
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from LLM import LLMCallError
+
+# Items whose LLM call failed for good are recorded here instead of being scored:
+#   python eval/TR_eval.py                           -> failures in res/dead_letter/TR_<model>.jsonl
+#   python dead_letter.py status                     -> failed items per task, model and error class
+#   python dead_letter.py replay eval/TR_eval.py     -> re-run only the dead-lettered items
+# Replay sets CHEMTABLE_DEAD_LETTER_REPLAY=1 for the script, which can also be set by hand.
+# A normal (resumed) run retries dead-lettered items too, since they have no result.
+
+DEAD_LETTER_DIR = os.environ.get("CHEMTABLE_DEAD_LETTER_DIR", "res/dead_letter")
+REPLAY_ENV = "CHEMTABLE_DEAD_LETTER_REPLAY"
+
+
+def _hashable(key):
+    # Keys round-trip through JSON, so tuple keys come back as lists.
+    return tuple(_hashable(k) for k in key) if isinstance(key, list) else key
+
+
+def read_entries(path):
+    """Current failures in a dead-letter file: the last entry per key, without
+    the keys that were resolved afterwards."""
+    if not os.path.exists(path):
+        return []
+    entries = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            key = _hashable(entry["key"])
+            if entry.get("resolved"):
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+    return list(entries.values())
+
+
+class DeadLetterQueue:
+    """Failed items of one task and model, one JSON line per failure.
+
+    The file is only appended to while a script runs: a failure adds an entry, and
+    an item that succeeds after having failed adds a "resolved" marker, so an
+    interrupted run never loses entries. `report` compacts the file at the end.
+    In replay mode `should_run` limits the script to the items that were failed
+    when it started."""
+
+    def __init__(self, task, model_name, directory=DEAD_LETTER_DIR):
+        self.task = task
+        self.model_name = model_name
+        self.path = os.path.join(directory, f"{task}_{model_name.replace('/', '_')}.jsonl")
+        self.replaying = os.environ.get(REPLAY_ENV) == "1"
+        self.count = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.failed_keys = {_hashable(entry["key"]) for entry in self.entries()}
+        if self.replaying:
+            print(f"Replaying {len(self.failed_keys)} dead-lettered items for {task} ({model_name})")
+
+    def entries(self):
+        return read_entries(self.path)
+
+    def should_run(self, key):
+        return not self.replaying or _hashable(key) in self.failed_keys
+
+    def keep_unreplayed(self, results_path, key):
+        """For scripts that rewrite their results file as a whole: the earlier
+        results in `results_path` that a replay keeps, i.e. those whose `key(result)`
+        is not being re-run. Empty outside replay mode, where the file is redone."""
+        if not self.replaying or not os.path.exists(results_path):
+            return []
+        with open(results_path, 'r', encoding='utf-8') as f:
+            return [result for result in map(json.loads, f) if not self.should_run(key(result))]
+
+    def add(self, key, error):
+        entry = {
+            "key": key,
+            "task": self.task,
+            "model": self.model_name,
+            "error_class": error.error_class if isinstance(error, LLMCallError) else type(error).__name__,
+            "attempts": error.attempts if isinstance(error, LLMCallError) else None,
+            "error": str(error),
+            "time": time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with self._lock:
+            self.count += 1
+            self.failed_keys.add(_hashable(key))
+            self._append(entry)
+
+    def resolve(self, key):
+        """Drop `key` from the queue after its item succeeded."""
+        key = _hashable(key)
+        with self._lock:
+            if key not in self.failed_keys:
+                return
+            self.failed_keys.discard(key)
+            self._append({"key": key, "resolved": True, "time": time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    def _append(self, entry):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def compact(self):
+        with self._lock:
+            entries = self.entries()
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            os.replace(tmp_path, self.path)
+
+    def report(self):
+        self.compact()
+        if self.count:
+            print(f"{self.count} items of {self.task} ({self.model_name}) failed and were dead-lettered to {self.path}; "
+                  f"re-run them with: python dead_letter.py replay {sys.argv[0]}")
+        elif self.replaying and self.failed_keys:
+            print(f"{len(self.failed_keys)} dead-lettered items of {self.task} ({self.model_name}) were not re-run "
+                  f"and stay in {self.path}")
+
+
+def status(directory):
+    for path in sorted(glob.glob(os.path.join(directory, "*.jsonl"))):
+        by_class = {}
+        for entry in read_entries(path):
+            error_class = entry.get("error_class")
+            by_class[error_class] = by_class.get(error_class, 0) + 1
+        if by_class:
+            details = ", ".join(f"{k}: {v}" for k, v in sorted(by_class.items(), key=lambda kv: str(kv[0])))
+            print(f"{os.path.basename(path):<50} {sum(by_class.values()):>6}  ({details})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and replay items whose LLM calls failed')
+    parser.add_argument('command', choices=['status', 'replay'])
+    parser.add_argument('script', nargs='?', help='Evaluation script to replay, e.g. eval/TR_eval.py')
+    parser.add_argument('script_args', nargs=argparse.REMAINDER, help='Arguments passed on to the script')
+    parser.add_argument('--dir', default=DEAD_LETTER_DIR, help='Dead-letter directory')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        status(args.dir)
+    else:
+        if not args.script:
+            parser.error("replay needs the evaluation script to run")
+        env = dict(os.environ, **{REPLAY_ENV: "1", "CHEMTABLE_DEAD_LETTER_DIR": args.dir})
+        sys.exit(subprocess.call([sys.executable, args.script] + args.script_args, env=env))
@@ -1,5 +1,6 @@
 from tqdm import tqdm
-from LLM import call_LLM
+from LLM import call_LLM, configure_workers, LLMCallError, LLMUnavailable
+from dead_letter import DeadLetterQueue
 from dataset import ChemTableDataset
 from template import *
 from utils import *
@@ -9,14 +10,20 @@ import os
 import json
 
 
-def process_item(item, llm_name):
+def process_item(item, llm_name, dead_letters):
     try:
         gt_html = item["clear_table_html"]
         image_path = item["image_path"]
         prompt = create_prompt(tsr_html_prompt, image_path)
-        resp = call_LLM(prompt, model_name=llm_name)
         try:
-            pre_html = extract_HTML(resp)
+            resp = call_LLM(prompt, model_name=llm_name, task="html")
+        except LLMCallError as e:
+            dead_letters.add(item["id"], e)
+            return None
+        try:
+            pre_html = extract_HTML(resp, repair=True)
+        except LLMUnavailable:
+            raise
         except Exception as e:
             print(e)
             print(resp)
@@ -65,11 +72,11 @@ def load_processed_items(llm_name):
 
 
 if __name__ == '__main__':
-    data_list = ChemTableDataset().getDataList()
+    dataset = ChemTableDataset()
     
     max_samples = 300
-    if len(data_list) > max_samples:
-        data_list = data_list[:max_samples]
+    data_list = dataset[:max_samples]
+    if len(dataset) > max_samples:
         print(f"Limiting evaluation to first {max_samples} samples")
     
     llm_list = [
@@ -79,18 +86,22 @@ if __name__ == '__main__':
     os.makedirs("res/TR", exist_ok=True)
     
     processed_items = {}
+    dead_letters = {}
     for llm_name in llm_list:
         processed_items[llm_name] = load_processed_items(llm_name)
+        dead_letters[llm_name] = DeadLetterQueue("TR", llm_name)
         print(f"{llm_name} has processed {len(processed_items[llm_name])} samples")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+    work = [(item, llm_name) for item in data_list for llm_name in llm_list
+            if item["id"] not in processed_items[llm_name] and dead_letters[llm_name].should_run(item["id"])]
+    # Only prefetch images that will be taken: an untaken prefetch holds its slot for good.
+    prefetch_images([item["image_path"] for item, _ in work])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=configure_workers(models=llm_list)) as executor:
         future_to_info = {}
-        for item in data_list:
-            for llm_name in llm_list:
-                if item["id"] in processed_items[llm_name]:
-                    continue
-                future = executor.submit(process_item, item, llm_name)
-                future_to_info[future] = (item, llm_name)
+        for item, llm_name in work:
+            future = executor.submit(process_item, item, llm_name, dead_letters[llm_name])
+            future_to_info[future] = (item, llm_name)
 
         for future in tqdm(concurrent.futures.as_completed(future_to_info), total=len(future_to_info)):
             item, llm_name = future_to_info[future]
@@ -98,3 +109,7 @@ if __name__ == '__main__':
             save_result(result, llm_name)
             if result and "index" in result:
                 processed_items[llm_name].add(result["index"])
+                dead_letters[llm_name].resolve(result["index"])
+
+    for queue in dead_letters.values():
+        queue.report()
@@ -1,8 +1,9 @@
 import json
 import os
 from tqdm import tqdm
-from LLM import call_LLM
-from utils import create_prompt, extract_json
+from LLM import call_LLM, LLMUnavailable, LLMCallError, configure_workers
+from dead_letter import DeadLetterQueue
+from utils import create_prompt, extract_json, group_by_image, answer_packed_group, prefetch_images
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from utils import evaluate_answer
@@ -21,7 +22,7 @@ MODEL_LIST = [
 
 MAX_SAMPLES = 500
 
-def process_questions(model_name, output_file, num_threads=10):
+def process_questions(model_name, output_file, num_threads=None):
     results = []
     results_lock = threading.Lock()
     file_lock = threading.Lock()
@@ -37,16 +38,19 @@ def process_questions(model_name, output_file, num_threads=10):
             for line in f:
                 try:
                     data = json.loads(line.strip())
-                    evaluated_ids.add(data.get('image_id'))
+                    evaluated_ids.add((data.get('image_id'), data.get('question')))
                 except json.JSONDecodeError:
                     continue
         print(f"Found existing evaluation results, {len(evaluated_ids)} questions already evaluated")
     
-    qa_pairs_to_process = [qa for qa in qa_pairs if qa["id"] not in evaluated_ids]
+    qa_pairs_to_process = [qa for qa in qa_pairs if (qa["id"], qa["question"]) not in evaluated_ids]
+    
+    dead_letters = DeadLetterQueue("benzene_ring", model_name)
+    qa_pairs_to_process = [qa for qa in qa_pairs_to_process if dead_letters.should_run((qa["id"], qa["question"]))]
     
     pbar = tqdm(total=len(qa_pairs_to_process), desc=f"Processing questions ({model_name})", ncols=100)
     
-    def process_single_question(qa_pair):
+    def process_single_question(qa_pair, packed_answer=None):
         try:
             question = qa_pair["question"]
             ground_truth = qa_pair["answer"]
@@ -61,18 +65,23 @@ def process_questions(model_name, output_file, num_threads=10):
                 return None
             
             try:
-                prompt_template = qa_prompt_base_image
-                prompt_text = prompt_template.replace("{Question}", question)
-                prompt = create_prompt(prompt_text, image_path)
-                
-                llm_response = call_LLM(prompt, model_name=model_name)
+                llm_response = packed_answer
+                if llm_response is None:
+                    prompt_template = qa_prompt_base_image
+                    prompt_text = prompt_template.replace("{Question}", question)
+                    prompt = create_prompt(prompt_text, image_path)
+                    llm_response = call_LLM(prompt, model_name=model_name, task="qa_json")
                 
                 try:
-                    response_json = extract_json(llm_response)
+                    response_json = extract_json(llm_response, repair=True)
                     model_answer = response_json.get("answer", "")
+                except LLMUnavailable:
+                    raise
                 except Exception as e:
                     print(f"JSON parsing error: {str(e)}")
                     model_answer = llm_response
+            except LLMCallError:
+                raise
             except Exception as e:
                 print(f"Error processing question: {str(e)}")
                 pbar.update(1)
@@ -80,6 +89,8 @@ def process_questions(model_name, output_file, num_threads=10):
             
             try:
                 correctness = evaluate_answer(question, ground_truth, model_answer)
+            except LLMUnavailable:
+                raise
             except Exception as e:
                 print(f"Error evaluating answer: {str(e)}")
                 correctness = "unknown"
@@ -99,20 +110,35 @@ def process_questions(model_name, output_file, num_threads=10):
             with file_lock:
                 with open(output_file, 'a', encoding='utf-8') as f:
                     f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            dead_letters.resolve((image_id, question))
             
+        except LLMCallError as e:
+            dead_letters.add((image_id, question), e)
         except Exception as e:
             print(f"Error processing question: {str(e)}")
         finally:
             pbar.update(1)
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(process_single_question, qa_pairs_to_process)
+    def process_group(group):
+        image_id = group[0]["id"]
+        image_path = os.path.join(image_dir, image_id)
+        table_html = None
+        if not os.path.exists(image_path):
+            image_path = None
+        if answer_packed_group(group, model_name, process_single_question, image_path, table_html) is None:
+            pbar.update(len(group))
+    
+    groups = group_by_image(qa_pairs_to_process)
+    prefetch_images([os.path.join(image_dir, group[0]["id"]) for group in groups])
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [model_name])) as executor:
+        executor.map(process_group, groups)
     
     pbar.close()
+    dead_letters.report()
     
     return results
 
-def run_evaluation_for_model(model_name, num_threads=10):
+def run_evaluation_for_model(model_name, num_threads=None):
     model_file_name = model_name.replace('-', '_').replace('.', '_')
     output_file = os.path.join(output_dir, f"res_{model_file_name}.jsonl")
     
@@ -136,7 +162,7 @@ def run_evaluation_for_model(model_name, num_threads=10):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Evaluate model performance on benzene ring counting dataset')
     parser.add_argument('--model', type=str, help='Specify the model name to evaluate')
-    parser.add_argument('--threads', type=int, default=10, help='Number of threads')
+    parser.add_argument('--threads', type=int, default=None, help='Maximum concurrent requests (default: adaptive)')
     
     args = parser.parse_args()
     
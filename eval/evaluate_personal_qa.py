@@ -1,10 +1,11 @@
 import json
 import os
 from tqdm import tqdm
-from LLM import call_LLM
+from LLM import call_LLM, configure_workers, LLMCallError, LLMUnavailable
+from dead_letter import DeadLetterQueue
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from utils import extract_json, create_prompt
+from utils import extract_json, create_prompt, group_by_image, answer_packed_group, prefetch_images
 from template import *
 from dataset import ChemTableDataset
 
@@ -19,7 +20,7 @@ output_dir = f"res/personal_{QA_MODE}"
 model_verify = "gpt-4.1-nano-2025-04-14"
 image_dir = "data/img"
 html_dataset = None
-num_threads = 20
+num_threads = None
 limit_questions = None
 
 os.makedirs(output_dir, exist_ok=True)
@@ -42,14 +43,13 @@ def load_html_dataset():
         html_dataset = ChemTableDataset()
         print("HTML dataset loaded")
 
-def process_questions(model_name, limit=None, num_threads=20):
+def process_questions(model_name, limit=None, num_threads=None):
     results = []
     stats = {"total": 0, "correct": 0, "incorrect": 0, "unknown": 0}
     results_lock = threading.Lock()
     
     if QA_MODE in ["html", "hybrid"]:
         load_html_dataset()
-        html_map = {f"{item['id']}.png": item["clear_table_html"] for item in html_dataset.getDataList()}
 
     with open(input_file, 'r', encoding='utf-8') as f:
         qa_pairs = [json.loads(line) for line in f]
@@ -57,11 +57,19 @@ def process_questions(model_name, limit=None, num_threads=20):
     if limit:
         qa_pairs = qa_pairs[:limit]
     
-    pbar = tqdm(total=len(qa_pairs), desc=f"Evaluating model {model_name}", ncols=100)
-    
     output_file = os.path.join(output_dir, f"res_{model_name.replace('-', '_').replace('.', '_')}.jsonl")
     
-    def process_single_question(qa_pair):
+    dead_letters = DeadLetterQueue("personal_qa", model_name)
+    for result in dead_letters.keep_unreplayed(output_file, lambda r: (r["id"], r["question"])):
+        results.append(result)
+        stats["total"] += 1
+        is_correct = result["is_correct"]
+        stats[is_correct if is_correct in ("correct", "incorrect") else "unknown"] += 1
+    qa_pairs = [qa for qa in qa_pairs if dead_letters.should_run((qa["id"], qa["question"]))]
+    
+    pbar = tqdm(total=len(qa_pairs), desc=f"Evaluating model {model_name}", ncols=100)
+    
+    def process_single_question(qa_pair, packed_answer=None):
         try:
             question = qa_pair["question"]
             ground_truth = qa_pair["answer"]
@@ -73,31 +81,34 @@ def process_questions(model_name, limit=None, num_threads=20):
                 pbar.update(1)
                 return None
             
-            if QA_MODE in ["html", "hybrid"] and image_id not in html_map:
+            if QA_MODE in ["html", "hybrid"] and html_dataset.table_html(image_id, None) is None:
                 pbar.update(1)
                 return None
             
-            prompt_text = answer_prompt.replace("{Question}", question)
-            
-            if QA_MODE in ["html", "hybrid"]:
-                prompt_text = prompt_text.replace("{Table_html}", html_map.get(image_id, ""))
-            
-            if QA_MODE == "html":
-                prompt = [{"role": "user", "content": prompt_text}]
-            else:
-                prompt = create_prompt(prompt_text, image_path)
-            
-            model_answer_response = call_LLM(prompt, model_name=model_name)
+            model_answer_response = packed_answer
+            if model_answer_response is None:
+                prompt_text = answer_prompt.replace("{Question}", question)
+                
+                if QA_MODE in ["html", "hybrid"]:
+                    prompt_text = prompt_text.replace("{Table_html}", html_dataset.table_html(image_id))
+                
+                if QA_MODE == "html":
+                    prompt = [{"role": "user", "content": prompt_text}]
+                else:
+                    prompt = create_prompt(prompt_text, image_path)
+                model_answer_response = call_LLM(prompt, model_name=model_name, task="qa_json")
             
             try:
-                response_json = extract_json(model_answer_response)
+                response_json = extract_json(model_answer_response, repair=True)
                 model_answer_text = response_json.get("answer", model_answer_response)
+            except LLMUnavailable:
+                raise
             except Exception:
                 model_answer_text = model_answer_response
             
             verify_content = verify_prompt.replace("{Question}", question).replace("{Answer}", ground_truth).replace("{Model_Answer}", model_answer_text)
             verify_messages = [{"role": "user", "content": verify_content}]
-            verify_response = call_LLM(verify_messages, model_name=model_verify)
+            verify_response = call_LLM(verify_messages, model_name=model_verify, task="judge")
             
             try:
                 verification = extract_json(verify_response)
@@ -134,17 +145,39 @@ def process_questions(model_name, limit=None, num_threads=20):
                 if len(results) % 10 == 0:
                     save_results(results, output_file)
                 
+        except LLMCallError as e:
+            dead_letters.add((qa_pair["id"], qa_pair["question"]), e)
         except Exception as e:
             print(f"Error processing question: {str(e)}")
         finally:
             pbar.update(1)
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(process_single_question, qa_pairs)
+    def process_group(group):
+        image_id = group[0]["id"]
+        image_path = os.path.join(image_dir, image_id)
+        if QA_MODE == "html" or not os.path.exists(image_path):
+            image_path = None
+        table_html = html_dataset.table_html(image_id, None) if QA_MODE in ["html", "hybrid"] else None
+        if QA_MODE in ["html", "hybrid"] and table_html is None:
+            # Asked one by one, these questions are skipped for lack of HTML.
+            image_path = None
+        if answer_packed_group(group, model_name, process_single_question, image_path, table_html) is None:
+            pbar.update(len(group))
+    
+    groups = group_by_image(qa_pairs)
+    if QA_MODE != "html":
+        # Questions without HTML are skipped in hybrid mode, so their images would never be taken.
+        prefetch_images([os.path.join(image_dir, group[0]["id"]) for group in groups
+                         if QA_MODE == "image" or html_dataset.table_html(group[0]["id"], None) is not None])
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [model_name, model_verify])) as executor:
+        executor.map(process_group, groups)
     
     pbar.close()
     
     save_results(results, output_file)
+    for result in results:
+        dead_letters.resolve((result["id"], result["question"]))
+    dead_letters.report()
     return results, stats
 
 def save_results(results, output_file):
@@ -189,12 +222,12 @@ def analyze_results(results, stats, model_name):
     file_name = f"res_{model_name.replace('-', '_').replace('.', '_')}.jsonl"
     print(f"Detailed results saved to {os.path.join(output_dir, file_name)}")
 
-def batch_evaluate_models(models, limit=None, num_threads=20):
+def batch_evaluate_models(models, limit=None, num_threads=None):
     all_stats = {}
     
     print(f"\nBatch Evaluation Configuration:")
     print(f"QA Mode: {QA_MODE}")
-    print(f"Threads: {num_threads}")
+    print(f"Threads: {num_threads or 'adaptive'}")
     print(f"Question Limit: {limit if limit is not None else 'No limit'}")
     
     for model_name in models:
@@ -248,7 +281,7 @@ def run_default_evaluation():
     print(f"Running evaluation with configuration from file header")
     print(f"QA Mode: {QA_MODE}")
     print(f"Models to evaluate: {', '.join(models_to_evaluate)}")
-    print(f"Threads: {threads}")
+    print(f"Threads: {threads or 'adaptive'}")
     print(f"Question limit: {limit if limit is not None else 'No limit'}")
     print(f"Input file: {input_file}")
     
@@ -274,7 +307,7 @@ def main():
     parser.add_argument('--models', type=str, help='Multiple models to evaluate, comma-separated')
     parser.add_argument('--models-file', type=str, help='File containing list of models to evaluate, one per line')
     parser.add_argument('--limit', type=int, default=None, help='Limit number of questions to process (for testing)')
-    parser.add_argument('--threads', type=int, default=20, help='Number of threads to use')
+    parser.add_argument('--threads', type=int, default=None, help='Maximum concurrent requests (default: adaptive)')
     parser.add_argument('--input', type=str, default=input_file, help='Input data file path')
     parser.add_argument('--qa-mode', type=str, choices=['html', 'image', 'hybrid'], default=QA_MODE, 
                       help='QA mode: html, image, hybrid')
@@ -291,7 +324,7 @@ def main():
         if args.input != input_file:
             input_file = args.input
             
-        if args.threads != 20:
+        if args.threads is not None:
             threads = args.threads
             
         if args.limit is not None:
@@ -7,11 +7,12 @@ import queue
 from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 from template import qa_prompt_base_image
-from utils import evaluate_answer, extract_json, encode_image
-from LLM import call_LLM
+from utils import evaluate_answer, extract_json, image_data_url, group_by_image, answer_packed_group, prefetch_images
+from LLM import call_LLM, configure_workers, LLMCallError
+from dead_letter import DeadLetterQueue
 
 
-def process_single_question(qa_item, images_dir, model_name, output_file, lock):
+def process_single_question(qa_item, images_dir, model_name, output_file, lock, dead_letters, packed_answer=None):
     id_value = qa_item.get('id')
     
     image_path = os.path.join(images_dir, id_value)
@@ -27,31 +28,33 @@ def process_single_question(qa_item, images_dir, model_name, output_file, lock):
         print(f"Question {id_value} is marked as unable to answer, will verify if model correctly refuses to answer")
     
     try:
-        prompt = qa_prompt_base_image.replace("{Question}", question)
-        
-        image_base64 = encode_image(image_path)
-        
         print(f"Processing question {id_value}: {question}")
         
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
+        response = packed_answer
+        if response is None:
+            prompt = qa_prompt_base_image.replace("{Question}", question)
+            
+            image_url = image_data_url(image_path)
+            
+            messages = [
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url
+                            }
                         }
-                    }
-                ]
-            }
-        ]
-        
-        response = call_LLM(messages, model_name=model_name)
+                    ]
+                }
+            ]
+            
+            response = call_LLM(messages, model_name=model_name, task="qa_json")
         
         try:
-            result = extract_json(response)
+            result = extract_json(response, repair=True)
             model_answer = result.get('answer', '')
             correctness = evaluate_answer(question, ground_truth, model_answer)
             
@@ -68,20 +71,37 @@ def process_single_question(qa_item, images_dir, model_name, output_file, lock):
             with lock:
                 with open(output_file, 'a', encoding='utf-8') as f:
                     f.write(json.dumps(result_item, ensure_ascii=False) + '\n')
+            dead_letters.resolve((id_value, question))
             
             is_correct = correctness.lower() == 'correct'
             return (id_value, is_correct, True)
             
+        except LLMCallError:
+            raise
         except Exception as e:
             print(f"Failed to parse response for question {id_value}: {e}")
             return None
             
+    except LLMCallError as e:
+        dead_letters.add((id_value, question), e)
+        return None
     except Exception as e:
         print(f"Error processing question {id_value}: {e}")
         return None
 
 
-def process_qa_file(file_path, images_dir, model_name, output_file, evaluated=None, id_range=None, num_threads=10, max_samples=None):
+def process_question_group(group, images_dir, model_name, output_file, lock, dead_letters):
+    image_path = os.path.join(images_dir, group[0].get('id'))
+    results = answer_packed_group(
+        group, model_name,
+        lambda qa_item, answer: process_single_question(qa_item, images_dir, model_name, output_file, lock,
+                                                        dead_letters, answer),
+        image_path if os.path.exists(image_path) else None
+    )
+    return results or []
+
+
+def process_qa_file(file_path, images_dir, model_name, output_file, evaluated=None, id_range=None, num_threads=None, max_samples=None):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
     if evaluated is None:
@@ -91,7 +111,7 @@ def process_qa_file(file_path, images_dir, model_name, output_file, evaluated=No
                 for line in f:
                     try:
                         data = json.loads(line.strip())
-                        evaluated.add(data.get('id'))
+                        evaluated.add((data.get('id'), data.get('question', '')))
                     except json.JSONDecodeError:
                         continue
     
@@ -103,6 +123,7 @@ def process_qa_file(file_path, images_dir, model_name, output_file, evaluated=No
         qa_data = [json.loads(line.strip()) for line in f if line.strip()]
     
     file_lock = threading.Lock()
+    dead_letters = DeadLetterQueue(os.path.splitext(os.path.basename(file_path))[0], model_name)
     
     questions_to_process = []
     
@@ -118,12 +139,14 @@ def process_qa_file(file_path, images_dir, model_name, output_file, evaluated=No
                 pass
         
         total_questions += 1
+        key = (id_value, qa_item.get('question', ''))
         
-        if id_value in evaluated:
+        if key in evaluated:
             evaluated_questions += 1
             continue
         
-        questions_to_process.append(qa_item)
+        if dead_letters.should_run(key):
+            questions_to_process.append(qa_item)
     
     if max_samples is not None:
         remaining_samples = max_samples - len(evaluated)
@@ -142,28 +165,33 @@ def process_qa_file(file_path, images_dir, model_name, output_file, evaluated=No
             print(f"Limiting sample processing to {remaining_samples} (total to process: {len(questions_to_process)})")
             questions_to_process = questions_to_process[:remaining_samples]
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [model_name])) as executor:
+        groups = group_by_image(questions_to_process)
+        prefetch_images([os.path.join(images_dir, group[0].get('id')) for group in groups])
         futures = []
-        for qa_item in questions_to_process:
+        for group in groups:
             futures.append(
                 executor.submit(
-                    process_single_question, 
-                    qa_item, 
+                    process_question_group, 
+                    group, 
                     images_dir, 
                     model_name, 
                     output_file, 
-                    file_lock
+                    file_lock,
+                    dead_letters
                 )
             )
         
         for future in futures:
-            result = future.result()
-            if result:
-                id_value, is_correct, was_evaluated = result
-                if was_evaluated:
-                    evaluated_questions += 1
-                    if is_correct:
-                        correct_answers += 1
+            for result in future.result():
+                if result:
+                    id_value, is_correct, was_evaluated = result
+                    if was_evaluated:
+                        evaluated_questions += 1
+                        if is_correct:
+                            correct_answers += 1
+    
+    dead_letters.report()
     
     if os.path.exists(output_file):
         correct_in_file = 0
@@ -211,7 +239,7 @@ def main():
     parser.add_argument('--output_dir', default='res/table_qa', help='Results output directory')
     parser.add_argument('--id_min', default=None, type=int, help='Minimum ID range value')
     parser.add_argument('--id_max', default=None, type=int, help='Maximum ID range value')
-    parser.add_argument('--threads', default=30, type=int, help='Number of threads for parallel processing')
+    parser.add_argument('--threads', default=None, type=int, help='Maximum concurrent requests per model (default: adaptive)')
     parser.add_argument('--test_refusing', action='store_true', help='Test if model can correctly refuse to answer unanswerable questions')
     parser.add_argument('--max_samples', default=None, type=int, help='Maximum evaluation sample count')
     parser.add_argument('--resume', action='store_true', default=True, help='Continue from checkpoint')
@@ -234,7 +262,10 @@ def main():
     if args.max_samples is not None:
         print(f"Will limit each model to evaluate at most {args.max_samples} samples per dataset")
     
-    print(f"Using {args.threads} threads for parallel evaluation")
+    if args.threads:
+        print(f"Using {args.threads} threads for parallel evaluation")
+    else:
+        print("Using adaptive concurrency for parallel evaluation")
     if args.test_refusing:
         print("Will test model's ability to refuse answering unanswerable questions")
     
@@ -260,10 +291,10 @@ def main():
                         for line in f:
                             try:
                                 data = json.loads(line.strip())
-                                evaluated.add(data.get('id'))
+                                evaluated.add((data.get('id'), data.get('question', '')))
                             except json.JSONDecodeError:
                                 continue
-                    print(f"Read {len(evaluated)} previously evaluated question IDs from {output_file}")
+                    print(f"Read {len(evaluated)} previously evaluated questions from {output_file}")
             
             result = process_qa_file(
                 qa_file, 
@@ -2,48 +2,30 @@ import json
 import os
 import argparse
 from tqdm import tqdm
-from LLM import call_LLM
-from utils import create_prompt, extract_json, evaluate_answer
+from LLM import call_LLM, LLMUnavailable, LLMCallError, configure_workers
+from dead_letter import DeadLetterQueue
+from utils import create_prompt, extract_json, evaluate_answer, group_by_image, answer_packed_group, prefetch_images
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from template import qa_prompt_base_image, qa_prompt_base_html, qa_prompt_base_hybrid
 from dataset import ChemTableDataset
 
-parser = argparse.ArgumentParser(description='Evaluate logical reasoning trend questions')
-parser.add_argument('--qa_mode', type=str, choices=['image', 'html', 'hybrid'], default='hybrid',
-                   help='QA mode: image(only image), html(only HTML), hybrid(image+HTML)')
-parser.add_argument('--model', type=str, default=None,
-                   help='Specify model to evaluate, if not specified evaluate all models')
-parser.add_argument('--threads', type=int, default=20,
-                   help='Number of processing threads')
-args = parser.parse_args()
-
 data_file = "data/qa_en/logical_reasoning_trend.jsonl"
 image_dir = "data/img"
-output_dir = f"res/logical_reasoning_trend/{args.qa_mode}"
-qa_mode = args.qa_mode
-
-os.makedirs(output_dir, exist_ok=True)
+# Set from the command line in __main__; spawned worker processes re-import this
+# script, so nothing with side effects runs at module level.
+qa_mode = "hybrid"
+output_dir = f"res/logical_reasoning_trend/{qa_mode}"
 
 MODEL_LIST = [
     "gpt-4.1-2025-04-14",
 ]
 
-if args.model:
-    MODEL_LIST = [model for model in MODEL_LIST if model == args.model]
-
 MAX_SAMPLES = 1000
 
-html_data_dict = {}
-if qa_mode == "html" or qa_mode == "hybrid":
-    print(f"Loading HTML data...")
-    chem_dataset = ChemTableDataset()
-    data_list = chem_dataset.getDataList()
-    for item in data_list:
-        html_data_dict[f"{item['id']}.png"] = item["clear_table_html"]
-    print(f"Successfully loaded {len(html_data_dict)} HTML data entries")
+chem_dataset = None
 
-def process_questions(model_name, output_file, num_threads=10):
+def process_questions(model_name, output_file, num_threads=None):
     results = []
     results_lock = threading.Lock()
     file_lock = threading.Lock()
@@ -59,21 +41,24 @@ def process_questions(model_name, output_file, num_threads=10):
             for line in f:
                 try:
                     result = json.loads(line)
-                    processed_ids.add(result["image_id"])
+                    processed_ids.add((result["image_id"], result["question"]))
                     results.append(result)
                 except json.JSONDecodeError:
                     continue
         print(f"Loaded {len(processed_ids)} processed results from file")
     
-    qa_pairs_to_process = [qa for qa in qa_pairs if qa["id"] not in processed_ids]
+    qa_pairs_to_process = [qa for qa in qa_pairs if (qa["id"], qa["question"]) not in processed_ids]
     
     if not qa_pairs_to_process:
         print(f"All questions processed, total {len(results)} results")
         return results
     
+    dead_letters = DeadLetterQueue("logical_reasoning", model_name)
+    qa_pairs_to_process = [qa for qa in qa_pairs_to_process if dead_letters.should_run((qa["id"], qa["question"]))]
+    
     pbar = tqdm(total=len(qa_pairs_to_process), desc=f"Processing questions ({model_name})", ncols=100)
     
-    def process_single_question(qa_pair):
+    def process_single_question(qa_pair, packed_answer=None):
         try:
             question = qa_pair["question"]
             ground_truth = qa_pair["answer"]
@@ -88,37 +73,42 @@ def process_questions(model_name, output_file, num_threads=10):
                 return None
             
             try:
-                if qa_mode == "image":
-                    prompt_template = qa_prompt_base_image
-                    prompt_text = prompt_template.replace("{Question}", question)
-                    prompt = create_prompt(prompt_text, image_path)
-                elif qa_mode == "html":
-                    prompt_template = qa_prompt_base_html
-                    table_html = html_data_dict.get(image_id, "")
-                    if not table_html:
-                        print(f"HTML data not found: {image_id}")
-                        pbar.update(1)
-                        return None
-                    prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
-                    prompt = create_prompt(prompt_text)
-                elif qa_mode == "hybrid":
-                    prompt_template = qa_prompt_base_hybrid
-                    table_html = html_data_dict.get(image_id, "")
-                    if not table_html:
-                        print(f"HTML data not found: {image_id}")
-                        pbar.update(1)
-                        return None
-                    prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
-                    prompt = create_prompt(prompt_text, image_path)
-                
-                llm_response = call_LLM(prompt, model_name=model_name)
+                llm_response = packed_answer
+                if llm_response is None:
+                    if qa_mode == "image":
+                        prompt_template = qa_prompt_base_image
+                        prompt_text = prompt_template.replace("{Question}", question)
+                        prompt = create_prompt(prompt_text, image_path)
+                    elif qa_mode == "html":
+                        prompt_template = qa_prompt_base_html
+                        table_html = chem_dataset.table_html(image_id)
+                        if not table_html:
+                            print(f"HTML data not found: {image_id}")
+                            pbar.update(1)
+                            return None
+                        prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
+                        prompt = create_prompt(prompt_text)
+                    elif qa_mode == "hybrid":
+                        prompt_template = qa_prompt_base_hybrid
+                        table_html = chem_dataset.table_html(image_id)
+                        if not table_html:
+                            print(f"HTML data not found: {image_id}")
+                            pbar.update(1)
+                            return None
+                        prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
+                        prompt = create_prompt(prompt_text, image_path)
+                    llm_response = call_LLM(prompt, model_name=model_name, task="qa_json")
                 
                 try:
-                    response_json = extract_json(llm_response)
+                    response_json = extract_json(llm_response, repair=True)
                     model_answer = response_json.get("answer", "")
+                except LLMUnavailable:
+                    raise
                 except Exception as e:
                     print(f"JSON parsing error: {str(e)}")
                     model_answer = llm_response
+            except LLMCallError:
+                raise
             except Exception as e:
                 print(f"Error processing question: {str(e)}")
                 pbar.update(1)
@@ -126,6 +116,8 @@ def process_questions(model_name, output_file, num_threads=10):
             
             try:
                 correctness = evaluate_answer(question, ground_truth, model_answer)
+            except LLMUnavailable:
+                raise
             except Exception as e:
                 print(f"Error evaluating answer: {str(e)}")
                 correctness = "unknown"
@@ -145,20 +137,41 @@ def process_questions(model_name, output_file, num_threads=10):
             with file_lock:
                 with open(output_file, 'a', encoding='utf-8') as f:
                     f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            dead_letters.resolve((image_id, question))
             
+        except LLMCallError as e:
+            dead_letters.add((image_id, question), e)
         except Exception as e:
             print(f"Error processing question: {str(e)}")
         finally:
             pbar.update(1)
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(process_single_question, qa_pairs_to_process)
+    def process_group(group):
+        image_id = group[0]["id"]
+        image_path = os.path.join(image_dir, image_id)
+        if qa_mode == "html" or not os.path.exists(image_path):
+            image_path = None
+        table_html = chem_dataset.table_html(image_id, None) if qa_mode != "image" else None
+        if qa_mode != "image" and not table_html:
+            # Asked one by one, these questions are skipped for lack of HTML.
+            image_path = None
+        if answer_packed_group(group, model_name, process_single_question, image_path, table_html) is None:
+            pbar.update(len(group))
+    
+    groups = group_by_image(qa_pairs_to_process)
+    if qa_mode != "html":
+        # Questions without HTML are skipped in hybrid mode, so their images would never be taken.
+        prefetch_images([os.path.join(image_dir, group[0]["id"]) for group in groups
+                         if qa_mode == "image" or chem_dataset.table_html(group[0]["id"], None)])
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [model_name])) as executor:
+        executor.map(process_group, groups)
     
     pbar.close()
+    dead_letters.report()
     
     return results
 
-def run_evaluation_for_model(model_name, num_threads=10):
+def run_evaluation_for_model(model_name, num_threads=None):
     model_file_name = model_name.replace('-', '_').replace('.', '_')
     output_file = os.path.join(output_dir, f"res_{model_file_name}_{qa_mode}.jsonl")
     
@@ -251,6 +264,26 @@ def analyze_question_types():
                 f.write(f"{category}: {accuracy:.2%} ({correct}/{len(category_results)})\n")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate logical reasoning trend questions')
+    parser.add_argument('--qa_mode', type=str, choices=['image', 'html', 'hybrid'], default='hybrid',
+                       help='QA mode: image(only image), html(only HTML), hybrid(image+HTML)')
+    parser.add_argument('--model', type=str, default=None,
+                       help='Specify model to evaluate, if not specified evaluate all models')
+    parser.add_argument('--threads', type=int, default=None,
+                       help='Maximum concurrent requests (default: adaptive)')
+    args = parser.parse_args()
+    
+    qa_mode = args.qa_mode
+    output_dir = f"res/logical_reasoning_trend/{qa_mode}"
+    os.makedirs(output_dir, exist_ok=True)
+    
+    if args.model:
+        MODEL_LIST = [model for model in MODEL_LIST if model == args.model]
+    
+    if qa_mode == "html" or qa_mode == "hybrid":
+        chem_dataset = ChemTableDataset()
+        print(f"Indexed {len(chem_dataset)} tables")
+    
     summary_file = os.path.join(output_dir, f"summary_{qa_mode}.txt")
     with open(summary_file, 'w', encoding='utf-8') as f:
         f.write(f"Logical Reasoning Trend Evaluation Summary (QA mode: {qa_mode})\n")
@@ -1,8 +1,9 @@
 import json
 import os
 from tqdm import tqdm
-from LLM import call_LLM
-from utils import create_prompt, extract_json, evaluate_answer
+from LLM import call_LLM, LLMUnavailable, LLMCallError, configure_workers
+from dead_letter import DeadLetterQueue
+from utils import create_prompt, extract_json, evaluate_answer, group_by_image, answer_packed_group, prefetch_images
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from template import qa_prompt_base_image
@@ -22,7 +23,7 @@ MODEL_LIST = [
     "qwen2.5-vl-72b-instruct"
 ]
 
-def process_questions(model_name, output_file, num_threads=10, max_samples=None, resume=False):
+def process_questions(model_name, output_file, num_threads=None, max_samples=None, resume=False):
     results = []
     results_lock = threading.Lock()
     file_lock = threading.Lock()
@@ -40,17 +41,20 @@ def process_questions(model_name, output_file, num_threads=10, max_samples=None,
                 for line in f:
                     try:
                         result = json.loads(line)
-                        processed_ids.add(result.get("image_id"))
+                        processed_ids.add((result.get("image_id"), result.get("question")))
                         results.append(result)
                     except:
                         pass
             print(f"Read {len(processed_ids)} processed results from file")
             
-            qa_pairs = [qa for qa in qa_pairs if qa["id"] not in processed_ids]
+            qa_pairs = [qa for qa in qa_pairs if (qa["id"], qa["question"]) not in processed_ids]
             print(f"Remaining {len(qa_pairs)} questions to process")
         except Exception as e:
             print(f"Error reading existing results: {str(e)}")
     
+    dead_letters = DeadLetterQueue("multihop_reference", model_name)
+    qa_pairs = [qa for qa in qa_pairs if dead_letters.should_run((qa["id"], qa["question"]))]
+    
     pbar = tqdm(total=len(qa_pairs), desc=f"Processing questions ({model_name})", ncols=100)
     
     total_questions = len(qa_pairs) + len(processed_ids)
@@ -72,7 +76,7 @@ def process_questions(model_name, output_file, num_threads=10, max_samples=None,
             if r.get("is_correct", False) and "unable to answer" in r.get("model_answer", "").lower():
                 unable_to_answer_correct += 1
     
-    def process_single_question(qa_pair):
+    def process_single_question(qa_pair, packed_answer=None):
         nonlocal correct_answers, total_questions
         nonlocal correct_hopn, total_hopn
         nonlocal unable_to_answer_correct, total_unable_to_answer
@@ -98,18 +102,23 @@ def process_questions(model_name, output_file, num_threads=10, max_samples=None,
                 return None
             
             try:
-                prompt_template = qa_prompt_base_image
-                prompt_text = prompt_template.replace("{Question}", question)
-                prompt = create_prompt(prompt_text, image_path)
-                
-                llm_response = call_LLM(prompt, model_name=model_name)
+                llm_response = packed_answer
+                if llm_response is None:
+                    prompt_template = qa_prompt_base_image
+                    prompt_text = prompt_template.replace("{Question}", question)
+                    prompt = create_prompt(prompt_text, image_path)
+                    llm_response = call_LLM(prompt, model_name=model_name, task="qa_json")
                 
                 try:
-                    response_json = extract_json(llm_response)
+                    response_json = extract_json(llm_response, repair=True)
                     model_answer = response_json.get("answer", "")
+                except LLMUnavailable:
+                    raise
                 except Exception as e:
                     print(f"JSON parsing error: {str(e)}")
                     model_answer = llm_response
+            except LLMCallError:
+                raise
             except Exception as e:
                 print(f"Error processing question: {str(e)}")
                 pbar.update(1)
@@ -126,6 +135,8 @@ def process_questions(model_name, output_file, num_threads=10, max_samples=None,
                     
                     if unable_to_answer and "unable to answer" in model_answer.lower():
                         unable_to_answer_correct += 1
+            except LLMUnavailable:
+                raise
             except Exception as e:
                 print(f"Error evaluating answer: {str(e)}")
                 correctness = "unknown"
@@ -148,16 +159,31 @@ def process_questions(model_name, output_file, num_threads=10, max_samples=None,
             with file_lock:
                 with open(output_file, 'a', encoding='utf-8') as f:
                     f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            dead_letters.resolve((image_id, question))
             
+        except LLMCallError as e:
+            dead_letters.add((image_id, question), e)
         except Exception as e:
             print(f"Error processing question: {str(e)}")
         finally:
             pbar.update(1)
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(process_single_question, qa_pairs)
+    def process_group(group):
+        image_id = group[0]["id"]
+        image_path = os.path.join(image_dir, image_id)
+        table_html = None
+        if not os.path.exists(image_path):
+            image_path = None
+        if answer_packed_group(group, model_name, process_single_question, image_path, table_html) is None:
+            pbar.update(len(group))
+    
+    groups = group_by_image(qa_pairs)
+    prefetch_images([os.path.join(image_dir, group[0]["id"]) for group in groups])
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [model_name])) as executor:
+        executor.map(process_group, groups)
     
     pbar.close()
+    dead_letters.report()
     
     accuracy = correct_answers / total_questions if total_questions > 0 else 0
     print(f"Model: {model_name}")
@@ -190,7 +216,7 @@ def process_questions(model_name, output_file, num_threads=10, max_samples=None,
     
     return results
 
-def run_evaluation_for_model(model_name, num_threads=10, max_samples=None, resume=False):
+def run_evaluation_for_model(model_name, num_threads=None, max_samples=None, resume=False):
     model_file_name = model_name.replace('-', '_').replace('.', '_')
     output_file = os.path.join(output_dir, f"res_{model_file_name}.jsonl")
     
@@ -251,8 +277,8 @@ if __name__ == "__main__":
                         help="Maximum number of samples to evaluate, default is all")
     parser.add_argument("--resume", default=True, action="store_true",
                         help="Resume from checkpoint")
-    parser.add_argument("--threads", type=int, default=10,
-                        help="Number of threads, default is 10")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Maximum concurrent requests, default is adaptive")
     parser.add_argument("--models", nargs="+", default=None,
                         help="List of models to evaluate, default is all models")
     args = parser.parse_args()
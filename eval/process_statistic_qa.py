@@ -1,9 +1,10 @@
 import json
 import os
 from tqdm import tqdm
-from LLM import call_qwen_llm, call_LLM
+from LLM import call_qwen_llm, call_LLM, configure_workers, LLMUnavailable, LLMCallError
+from dead_letter import DeadLetterQueue
 from dataset import ChemTableDataset
-from utils import create_prompt, extract_json, create_prompt_text
+from utils import create_prompt, extract_json, create_prompt_text, group_by_image, answer_packed_group, prefetch_images
 from template import *
 from qa_answer_eval import evaluate_answer
 import threading
@@ -19,7 +20,7 @@ image_dir = "data/img"
 
 os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-def process_questions(limit=None, num_threads=50):
+def process_questions(limit=None, num_threads=None):
     results = []
     results_lock = threading.Lock()
     
@@ -29,17 +30,16 @@ def process_questions(limit=None, num_threads=50):
     if limit:
         qa_pairs = qa_pairs[:limit]
     
+    dead_letters = DeadLetterQueue("process_statistic_qa", llm_name)
+    results = dead_letters.keep_unreplayed(output_file, lambda r: (r["image_id"], r["question"]))
+    qa_pairs = [qa for qa in qa_pairs if dead_letters.should_run((qa["id"], qa["question"]))]
+    
     pbar = tqdm(total=len(qa_pairs), desc="Processing questions", ncols=100)
-    data_list = ChemTableDataset().getDataList()
-    image_ids = {}
-    for item in data_list:
-        image_id = item["id"]
-        image_ids[f"{image_id}.png"] = item['clear_table_html']
+    dataset = ChemTableDataset()
     for item in qa_pairs:
-        key_ = f"{item['id']}"
-        item["table_html"] = image_ids[key_]
+        item["table_html"] = dataset.table_html(item["id"])
 
-    def process_single_question(qa_pair):
+    def process_single_question(qa_pair, packed_answer=None):
         try:
             question = qa_pair["question"]
             ground_truth = qa_pair["answer"]
@@ -51,22 +51,25 @@ def process_questions(limit=None, num_threads=50):
                 pbar.update(1)
                 return None
             
-            if qa_mode == "html":
-                prompt_text = qa_prompt_base_html.replace("{Question}", question).replace("{Table_html}", qa_pair["table_html"])
-                prompt = create_prompt_text(prompt_text)
-            elif qa_mode == "hybrid":
-                prompt_text = qa_prompt_base_hybrid.replace("{Question}", question).replace("{Table_html}", qa_pair["table_html"])
-                prompt = create_prompt(prompt_text, image_path)
-            else:
-                prompt_text = qa_prompt_base_image.replace("{Question}", question)
-                prompt = create_prompt(prompt_text, image_path)
-            
             try:
-                llm_response = call_LLM(prompt, model_name=llm_name)
+                llm_response = packed_answer
+                if llm_response is None:
+                    if qa_mode == "html":
+                        prompt_text = qa_prompt_base_html.replace("{Question}", question).replace("{Table_html}", qa_pair["table_html"])
+                        prompt = create_prompt_text(prompt_text)
+                    elif qa_mode == "hybrid":
+                        prompt_text = qa_prompt_base_hybrid.replace("{Question}", question).replace("{Table_html}", qa_pair["table_html"])
+                        prompt = create_prompt(prompt_text, image_path)
+                    else:
+                        prompt_text = qa_prompt_base_image.replace("{Question}", question)
+                        prompt = create_prompt(prompt_text, image_path)
+                    llm_response = call_LLM(prompt, model_name=llm_name, task="qa_json")
                 
                 try:
-                    response_json = extract_json(llm_response)
+                    response_json = extract_json(llm_response, repair=True)
                     model_answer = response_json.get("answer", "")
+                except LLMUnavailable:
+                    raise
                 except Exception:
                     model_answer = llm_response
                 
@@ -87,6 +90,8 @@ def process_questions(limit=None, num_threads=50):
                     if len(results) % 10 == 0:
                         save_results(results)
                 
+            except LLMCallError as e:
+                dead_letters.add((image_id, question), e)
             except Exception as e:
                 print(f"Error processing question: {str(e)}")
                 
@@ -95,11 +100,25 @@ def process_questions(limit=None, num_threads=50):
         finally:
             pbar.update(1)
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(process_single_question, qa_pairs)
+    def process_group(group):
+        image_path = os.path.join(image_dir, group[0]["id"])
+        if qa_mode == "html" or not os.path.exists(image_path):
+            image_path = None
+        table_html = group[0]["table_html"] if qa_mode != "image" else None
+        if answer_packed_group(group, llm_name, process_single_question, image_path, table_html) is None:
+            pbar.update(len(group))
+    
+    groups = group_by_image(qa_pairs)
+    if qa_mode != "html":
+        prefetch_images([os.path.join(image_dir, group[0]["id"]) for group in groups])
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [llm_name])) as executor:
+        executor.map(process_group, groups)
     
     pbar.close()
     save_results(results)
+    for result in results:
+        dead_letters.resolve((result["image_id"], result["question"]))
+    dead_letters.report()
     return results
 
 def save_results(results):
@@ -126,5 +145,5 @@ def calculate_statistics(results):
             categories[cat]["correct"] += 1
 
 if __name__ == "__main__":
-    results = process_questions(num_threads=30)
+    results = process_questions()
     calculate_statistics(results)
\ No newline at end of file
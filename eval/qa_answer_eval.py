@@ -1,59 +1,31 @@
 import json
 import os
 import time
-import base64
 from tqdm import tqdm
-from LLM import call_LLM
+from LLM import call_LLM, LLMUnavailable, LLMCallError
+from dead_letter import DeadLetterQueue
 from template import qa_prompt_base_image, qa_answer_eval
-from utils import extract_json
+from utils import extract_json, create_prompt
 
 data_file = "data/qa_en/statistic_qa.jsonl"
 output_file = "res/statistic_qa_results.jsonl"
 image_dir = "data/img"
+model_name = "gpt-4.1-2025-04-14"
 
 os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-def get_image_type(image_path):
-    ext = os.path.splitext(image_path)[1].lower()
-    if ext == '.jpg' or ext == '.jpeg':
-        return 'jpeg'
-    elif ext == '.png':
-        return 'png'
-    else:
-        return 'jpeg'
-
-def get_image_base64(image_path):
+def create_image_message(prompt, image_path):
     try:
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            return encoded_string
+        return create_prompt(prompt, image_path)
     except Exception as e:
         print(f"Failed to read image {image_path}: {e}")
         return None
 
-def create_image_message(prompt, image_path):
-    base64_image = get_image_base64(image_path)
-    if not base64_image:
-        return None
-    
-    return [{
-        "role": "user",
-        "content": [
-            {"type": "text", "text": prompt},
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/{get_image_type(image_path)};base64,{base64_image}"
-                }
-            }
-        ]
-    }]
-
 def evaluate_answer(question, ground_truth, model_answer):
     prompt = qa_answer_eval.replace("{Question}", question).replace("{Answer}", ground_truth).replace("{Model_Answer}", model_answer)
     
     try:
-        eval_response = call_LLM([{"role": "user", "content": prompt}], model_name="gpt-4")
+        eval_response = call_LLM([{"role": "user", "content": prompt}], model_name="gpt-4", task="judge")
         
         try:
             eval_result = extract_json(eval_response)
@@ -61,6 +33,8 @@ def evaluate_answer(question, ground_truth, model_answer):
         except json.JSONDecodeError:
             print(f"Failed to parse evaluation result: {eval_response}")
             return "unknown"
+    except LLMUnavailable:
+        raise
     except Exception as e:
         print(f"Error evaluating answer: {e}")
         return "unknown"
@@ -74,6 +48,10 @@ def process_questions(limit=10):
     if limit > 0:
         qa_pairs = qa_pairs[:limit]
     
+    dead_letters = DeadLetterQueue("statistic_qa", model_name)
+    results = dead_letters.keep_unreplayed(output_file, lambda r: (r["image_id"], r["question"]))
+    qa_pairs = [qa for qa in qa_pairs if dead_letters.should_run((qa["id"], qa["question"]))]
+    
     print(f"Loaded {len(qa_pairs)} questions")
     
     for i, qa_pair in enumerate(tqdm(qa_pairs)):
@@ -98,12 +76,14 @@ def process_questions(limit=10):
         try:
             print(f"Processing question {i+1}: {question}")
             
-            llm_response = call_LLM(messages)
+            llm_response = call_LLM(messages, model_name=model_name, task="qa_json")
             
             try:
-                response_json = json.loads(llm_response)
+                response_json = extract_json(llm_response, repair=True)
                 model_answer = response_json.get("answer", "")
-            except json.JSONDecodeError:
+            except LLMUnavailable:
+                raise
+            except Exception:
                 model_answer = llm_response
                 
             print(f"Model answer: {model_answer}")
@@ -123,12 +103,16 @@ def process_questions(limit=10):
             results.append(result)
             
             save_results(results)
+            dead_letters.resolve((image_id, question))
                 
             time.sleep(2)
             
+        except LLMCallError as e:
+            dead_letters.add((image_id, question), e)
         except Exception as e:
             print(f"Error processing question: {e}")
     
+    dead_letters.report()
     save_results(results)
     return results
 
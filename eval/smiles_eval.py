@@ -6,32 +6,54 @@ from queue import Queue
 import os
 import argparse
 
-from LLM import call_LLM
+from LLM import call_LLM, configure_workers, LLMUnavailable, LLMCallError
+from dead_letter import DeadLetterQueue
 from dataset import ChemTableDataset
 from template import get_smiles
 from utils import *
+from image_hash import group_similar
 
-def process_smiles(item, llm_name, result_queue):
-    for smiles in item["smiles"]:
-        smiles_id = smiles["smiles_id"]
-        smiles_image_path = smiles["smiles_image_path"]
-        smiles_gt = smiles["smiles_gt"].replace("[#smiles#]", "")
+def process_smiles(group, llm_name, result_queue, dead_letters):
+    """Query the model once with the first crop of `group`, a list of
+    (table id, smiles) pairs of near-identical crops, and score every member
+    against its own ground truth."""
+    rep_index, rep_smiles = group[0]
+    prompt = create_prompt(get_smiles, rep_smiles["smiles_image_path"], profile=MOLECULE_IMAGE_PROFILE)
+    try:
+        resp = call_LLM(prompt, model_name=llm_name, task="smiles")
+    except LLMCallError as e:
+        for index, smiles in group:
+            dead_letters.add((index, smiles["smiles_id"]), e)
+        return
+    except LLMUnavailable:
+        return
+    pre_smiles = extract_smiles_from_response(resp)
 
-        prompt = create_prompt(get_smiles, smiles_image_path)
-        resp = call_LLM(prompt, model_name=llm_name)
-        pre_smiles = extract_smiles_from_response(resp)
+    for index, smiles in group:
+        smiles_gt = smiles["smiles_gt"].replace("[#smiles#]", "")
         score = calculate_tanimoto_similarity(smiles_gt, pre_smiles)
         res = {
-            "index": item["id"],
-            "smiles_id": smiles_id,
+            "index": index,
+            "smiles_id": smiles["smiles_id"],
             "gt": smiles_gt,
             "pre": pre_smiles,
             "score": score,
             "llm_name": llm_name
         }
+        if (index, smiles["smiles_id"]) != (rep_index, rep_smiles["smiles_id"]):
+            res["answered_from"] = [rep_index, rep_smiles["smiles_id"]]
         result_queue.put(res)
 
-def result_writer(result_queue):
+def group_crops(work_items, dedup=True, max_distance=6):
+    """(table id, smiles) pairs of `work_items`, grouped by identical crop image
+    unless `dedup` is off."""
+    crops = [(item["id"], smiles) for item in work_items for smiles in item["smiles"]]
+    if not dedup:
+        return [[crop] for crop in crops]
+    groups = group_similar([smiles["smiles_image_path"] for _, smiles in crops], max_distance=max_distance)
+    return [[crops[i] for i in group] for group in groups]
+
+def result_writer(result_queue, dead_letters):
     results_by_model = {}
     
     while True:
@@ -44,6 +66,7 @@ def result_writer(result_queue):
         
         with open(result_file, 'a', encoding="utf-8") as f:
             f.write(json.dumps(res, ensure_ascii=False) + '\n')
+        dead_letters[llm_name].resolve((res["index"], res["smiles_id"]))
             
         if llm_name not in results_by_model:
             results_by_model[llm_name] = []
@@ -73,16 +96,22 @@ if __name__ == '__main__':
     parser.add_argument('--models', nargs='+', default=[
         "intern_vl"
     ], help='List of LLM models to evaluate')
-    parser.add_argument('--workers', type=int, default=10, help='Number of worker threads per model')
+    parser.add_argument('--workers', type=int, default=None, help='Maximum concurrent requests per model (default: adaptive)')
     parser.add_argument('--max_samples', type=int, default=1000, help='Maximum number of samples to evaluate')
     parser.add_argument('--resume', default=True, action='store_true', help='Resume from checkpoint')
+    parser.add_argument('--no_dedup', action='store_true',
+                        help='Query every molecule crop separately instead of once per group of identical crops')
+    parser.add_argument('--dedup_distance', type=int, default=6,
+                        help='Maximum dHash distance (bits of 256) for two crops to be compared pixel by pixel')
     args = parser.parse_args()
     
-    data_list = ChemTableDataset().getDataList()
+    dataset = ChemTableDataset()
     
     if args.max_samples is not None:
-        data_list = data_list[:args.max_samples]
+        data_list = dataset[:args.max_samples]
         print(f"Limiting evaluation to first {args.max_samples} samples")
+    else:
+        data_list = dataset.getDataList()
     
     os.makedirs("res/smiles", exist_ok=True)
     
@@ -94,41 +123,57 @@ if __name__ == '__main__':
                 print(f"Cleaned old result file: {result_file}")
     
     result_queue = Queue()
+    dead_letter_queues = {}
     
-    writer_thread = threading.Thread(target=result_writer, args=(result_queue,))
+    writer_thread = threading.Thread(target=result_writer, args=(result_queue, dead_letter_queues))
     writer_thread.daemon = True
     writer_thread.start()
     
     for llm_name in args.models:
         print(f"Starting model: {llm_name}")
         
+        dead_letters = dead_letter_queues[llm_name] = DeadLetterQueue("smiles", llm_name)
         processed_items = set()
         if args.resume:
             result_file = f"res/smiles/res_{llm_name}.jsonl"
             processed_items = get_processed_items(result_file)
             print(f"Model {llm_name} has processed {len(processed_items)} samples, resuming from checkpoint")
         
-        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        work_items = []
+        for item in data_list:
+            if args.resume or dead_letters.replaying:
+                unprocessed_smiles = []
+                for smiles in item["smiles"]:
+                    key = (item["id"], smiles["smiles_id"])
+                    if key not in processed_items and dead_letters.should_run(key):
+                        unprocessed_smiles.append(smiles)
+                
+                if not unprocessed_smiles:
+                    continue
+                
+                new_item = item.copy()
+                new_item["smiles"] = unprocessed_smiles
+                work_items.append(new_item)
+            else:
+                work_items.append(item)
+        
+        groups = group_crops(work_items, dedup=not args.no_dedup, max_distance=args.dedup_distance)
+        n_crops = sum(len(group) for group in groups)
+        if not args.no_dedup and n_crops > 0:
+            print(f"Dedup: {n_crops} molecule crops -> {len(groups)} queries "
+                  f"({1 - len(groups) / n_crops:.1%} saved)")
+        
+        prefetch_images([group[0][1]["smiles_image_path"] for group in groups], profile=MOLECULE_IMAGE_PROFILE)
+        
+        with ThreadPoolExecutor(max_workers=configure_workers(args.workers, [llm_name])) as executor:
             futures = []
-            for item in data_list:
-                if args.resume:
-                    unprocessed_smiles = []
-                    for smiles in item["smiles"]:
-                        if (item["id"], smiles["smiles_id"]) not in processed_items:
-                            unprocessed_smiles.append(smiles)
-                    
-                    if not unprocessed_smiles:
-                        continue
-                    
-                    new_item = item.copy()
-                    new_item["smiles"] = unprocessed_smiles
-                    futures.append(executor.submit(process_smiles, new_item, llm_name, result_queue))
-                else:
-                    futures.append(executor.submit(process_smiles, item, llm_name, result_queue))
+            for group in groups:
+                futures.append(executor.submit(process_smiles, group, llm_name, result_queue, dead_letters))
             
             for f in tqdm(futures, total=len(futures), desc=f"Processing {llm_name}"):
                 f.result()
         
+        dead_letters.report()
         print(f"Model {llm_name} processing completed")
     
     result_queue.put(None)
@@ -1,8 +1,9 @@
 import json
 import os
 from tqdm import tqdm
-from LLM import call_LLM
-from utils import create_prompt, extract_json, evaluate_answer
+from LLM import call_LLM, LLMUnavailable, LLMCallError, configure_workers
+from dead_letter import DeadLetterQueue
+from utils import create_prompt, extract_json, evaluate_answer, group_by_image, answer_packed_group, prefetch_images
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from template import qa_prompt_base_image, qa_prompt_base_html, qa_prompt_base_hybrid
@@ -20,14 +21,12 @@ MODEL_LIST = [
     "gpt-4.1-2025-04-14"
 ]
 
-def process_questions(model_name, output_file, num_threads=10, resume=False):
+def process_questions(model_name, output_file, num_threads=None, resume=False):
     results = []
     results_lock = threading.Lock()
     file_lock = threading.Lock()
     
     dataset = ChemTableDataset()
-    data_list = dataset.getDataList()
-    html_dict = {item["id"]: item["clear_table_html"] for item in data_list}
     
     with open(data_file, 'r', encoding='utf-8') as f:
         qa_pairs = [json.loads(line) for line in f]
@@ -39,18 +38,21 @@ def process_questions(model_name, output_file, num_threads=10, resume=False):
             for line in f:
                 try:
                     result = json.loads(line)
-                    processed_ids.add(result['image_id'])
+                    processed_ids.add((result['image_id'], result['question']))
                     results.append(result)
                 except:
                     pass
         print(f"Resuming from checkpoint, processed {len(processed_ids)} samples")
     
     if resume:
-        qa_pairs = [qa for qa in qa_pairs if qa['id'] not in processed_ids]
+        qa_pairs = [qa for qa in qa_pairs if (qa['id'], qa['question']) not in processed_ids]
+    
+    dead_letters = DeadLetterQueue("yield_conditions", model_name)
+    qa_pairs = [qa for qa in qa_pairs if dead_letters.should_run((qa["id"], qa["question"]))]
     
     pbar = tqdm(total=len(qa_pairs), desc=f"Processing questions ({model_name})", ncols=100)
     
-    def process_single_question(qa_pair):
+    def process_single_question(qa_pair, packed_answer=None):
         try:
             question = qa_pair["question"]
             ground_truth = qa_pair["answer"]
@@ -68,35 +70,40 @@ def process_questions(model_name, output_file, num_threads=10, resume=False):
             try:
                 image_id_num = int(os.path.splitext(image_id)[0])
                 
-                if QA_MODE == "image":
-                    prompt_template = qa_prompt_base_image
-                    prompt_text = prompt_template.replace("{Question}", question)
-                    prompt = create_prompt(prompt_text, image_path)
-                elif QA_MODE == "html":
-                    prompt_template = qa_prompt_base_html
-                    table_html = html_dict.get(image_id_num, "")
-                    prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
-                    prompt = create_prompt(prompt_text)
-                elif QA_MODE == "hybrid":
-                    prompt_template = qa_prompt_base_hybrid
-                    table_html = html_dict.get(image_id_num, "")
-                    prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
-                    prompt = create_prompt(prompt_text, image_path)
-                else:
-                    prompt_template = qa_prompt_base_image
-                    prompt_text = prompt_template.replace("{Question}", question)
-                    prompt = create_prompt(prompt_text, image_path)
-                
-                llm_response = call_LLM(prompt, model_name=model_name)
+                llm_response = packed_answer
+                if llm_response is None:
+                    if QA_MODE == "image":
+                        prompt_template = qa_prompt_base_image
+                        prompt_text = prompt_template.replace("{Question}", question)
+                        prompt = create_prompt(prompt_text, image_path)
+                    elif QA_MODE == "html":
+                        prompt_template = qa_prompt_base_html
+                        table_html = dataset.table_html(image_id_num)
+                        prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
+                        prompt = create_prompt(prompt_text)
+                    elif QA_MODE == "hybrid":
+                        prompt_template = qa_prompt_base_hybrid
+                        table_html = dataset.table_html(image_id_num)
+                        prompt_text = prompt_template.replace("{Question}", question).replace("{Table_html}", table_html)
+                        prompt = create_prompt(prompt_text, image_path)
+                    else:
+                        prompt_template = qa_prompt_base_image
+                        prompt_text = prompt_template.replace("{Question}", question)
+                        prompt = create_prompt(prompt_text, image_path)
+                    llm_response = call_LLM(prompt, model_name=model_name, task="qa_json")
                 
                 try:
-                    response_json = extract_json(llm_response)
+                    response_json = extract_json(llm_response, repair=True)
                     model_answer = response_json.get("answer", "")
                     model_thought = response_json.get("chain_of_thought", "")
+                except LLMUnavailable:
+                    raise
                 except Exception as e:
                     print(f"JSON parsing error: {str(e)}")
                     model_answer = llm_response
                     model_thought = llm_response
+            except LLMCallError:
+                raise
             except Exception as e:
                 print(f"Error processing question: {str(e)}")
                 pbar.update(1)
@@ -104,6 +111,8 @@ def process_questions(model_name, output_file, num_threads=10, resume=False):
             
             try:
                 correctness = evaluate_answer(question, ground_truth, model_answer)
+            except LLMUnavailable:
+                raise
             except Exception as e:
                 print(f"Error evaluating answer: {str(e)}")
                 correctness = "unknown"
@@ -125,16 +134,32 @@ def process_questions(model_name, output_file, num_threads=10, resume=False):
             with file_lock:
                 with open(output_file, 'a', encoding='utf-8') as f:
                     f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            dead_letters.resolve((image_id, question))
             
+        except LLMCallError as e:
+            dead_letters.add((image_id, question), e)
         except Exception as e:
             print(f"Error processing question: {str(e)}")
         finally:
             pbar.update(1)
     
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(process_single_question, qa_pairs)
+    def process_group(group):
+        image_id = group[0]["id"]
+        image_path = os.path.join(image_dir, image_id)
+        if QA_MODE == "html" or not os.path.exists(image_path):
+            image_path = None
+        table_html = dataset.table_html(image_id) if QA_MODE in ("html", "hybrid") else None
+        if answer_packed_group(group, model_name, process_single_question, image_path, table_html) is None:
+            pbar.update(len(group))
+    
+    groups = group_by_image(qa_pairs)
+    if QA_MODE != "html":
+        prefetch_images([os.path.join(image_dir, group[0]["id"]) for group in groups])
+    with ThreadPoolExecutor(max_workers=configure_workers(num_threads, [model_name])) as executor:
+        executor.map(process_group, groups)
     
     pbar.close()
+    dead_letters.report()
     
     correct_count = sum(1 for r in results if r["correctness"] == "correct")
     incorrect_count = sum(1 for r in results if r["correctness"] == "incorrect")
@@ -181,7 +206,7 @@ def process_questions(model_name, output_file, num_threads=10, resume=False):
     
     return results
 
-def run_evaluation_for_model(model_name, num_threads=10, resume=False):
+def run_evaluation_for_model(model_name, num_threads=None, resume=False):
     model_file_name = model_name.replace('-', '_').replace('.', '_')
     output_file = os.path.join(output_dir, f"res_{model_file_name}_{QA_MODE}.jsonl")
     
@@ -238,7 +263,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Evaluate model performance on yield_and_conditions dataset')
     parser.add_argument('--model', type=str, help='Specify model name to evaluate')
     parser.add_argument('--analyze', action='store_true', help='Analyze existing evaluation results')
-    parser.add_argument('--threads', type=int, default=20, help='Number of threads')
+    parser.add_argument('--threads', type=int, default=None, help='Maximum concurrent requests (default: adaptive)')
     parser.add_argument('--resume', default=True, action='store_true', help='Resume from checkpoint')
     
     args = parser.parse_args()
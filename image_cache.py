@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_IMAGE_CACHE_PATH = "cache/image_cache.sqlite"
+
+
+def image_key(image_path, params):
+    # A changed file gets a new mtime/size and therefore a new key; stale entries
+    # are simply never read again.
+    stat = os.stat(image_path)
+    request = {
+        "path": os.path.abspath(image_path),
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "params": params,
+        # Entries hold complete data: URLs (payload and MIME type).
+        "payload": "data_url"
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class EncodedImageCache:
+    """Ready-to-send image payloads: an in-memory LRU bounded by bytes, backed by
+    an optional SQLite store shared by all runs on the host."""
+
+    def __init__(self, max_memory_mb=256, path=None):
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.path = path
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, path TEXT, payload TEXT, created REAL)"
+            )
+
+    def get(self, image_path, params, encode):
+        """Return the payload for `image_path` encoded with `params`, calling
+        `encode(image_path)` only on a miss."""
+        key = image_key(image_path, params)
+        with self._lock:
+            payload = self._memory.get(key)
+            if payload is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return payload
+            if self._conn is not None:
+                row = self._conn.execute("SELECT payload FROM images WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+
+        # Encode outside the lock so that other threads are not serialised behind PIL.
+        payload = encode(image_path)
+        self.put(image_path, params, payload)
+        return payload
+
+    def contains(self, image_path, params):
+        key = image_key(image_path, params)
+        with self._lock:
+            if key in self._memory:
+                return True
+            if self._conn is None:
+                return False
+            return self._conn.execute("SELECT 1 FROM images WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, image_path, params, payload):
+        key = image_key(image_path, params)
+        with self._lock:
+            self._remember(key, payload)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO images (key, path, payload, created) VALUES (?, ?, ?, ?)",
+                    (key, image_path, payload, time.time())
+                )
+
+    def _remember(self, key, payload):
+        size = len(payload)
+        if size > self.max_memory:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = payload
+        self._memory_size += size
+        while self._memory_size > self.max_memory:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / total if total > 0 else 0,
+                "memory_mb": self._memory_size / 1024 / 1024
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,108 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageChops
+
+from image_preprocess import trim_border
+
+
+def dhash(image_path, hash_size=16):
+    """Difference hash of an image: one bit per horizontally adjacent pixel pair
+    of the trimmed, grayscale image shrunk to (hash_size + 1) x hash_size.
+    Returns (hash, aspect ratio of the trimmed image)."""
+    with Image.open(image_path) as image:
+        image = trim_border(image.convert("L"), margin=0)
+        aspect = image.width / image.height
+        pixels = list(image.resize((hash_size + 1, hash_size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits, aspect
+
+
+# Scripts evaluating several models group the same crops once per model.
+@functools.lru_cache(maxsize=None)
+def _try_dhash(image_path, hash_size):
+    try:
+        return dhash(image_path, hash_size)
+    except (OSError, ValueError, ZeroDivisionError) as e:
+        print(f"Cannot hash {image_path}: {e}")
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def _ink(image_path):
+    # Trimmed image with ink (dark) pixels at 255 and paper at 0.
+    with Image.open(image_path) as image:
+        return trim_border(image.convert("L"), margin=0).point(lambda v: 255 if v < 128 else 0)
+
+
+def same_drawing(path_a, path_b, max_pixel_diff=0.002):
+    """Whether two images show the same drawing pixel for pixel: their trimmed,
+    binarised versions have the same size and differ in at most
+    `max_pixel_diff` of the ink pixels of the first. A different substituent
+    label changes far more pixels than that; rescaled copies are not merged."""
+    try:
+        a, b = _ink(path_a), _ink(path_b)
+    except (OSError, ValueError) as e:
+        print(f"Cannot compare {path_a} and {path_b}: {e}")
+        return False
+    if a.size != b.size:
+        return False
+    ink = a.histogram()[255]
+    differing = ImageChops.difference(a, b).histogram()[255]
+    return differing <= max_pixel_diff * ink
+
+
+def _bands(bits, n_bands, n_bits):
+    width = -(-n_bits // n_bands)
+    mask = (1 << width) - 1
+    return [(i, (bits >> (i * width)) & mask) for i in range(n_bands)]
+
+
+def group_similar(image_paths, max_distance=6, max_aspect_diff=0.1, hash_size=16, max_pixel_diff=0.002, workers=8):
+    """Group identical images. Returns a list of groups of indices into
+    `image_paths`, in order of first appearance; the first index of a group is
+    its representative.
+
+    An image joins the first group whose representative's hash is at most
+    `max_distance` bits away, whose aspect ratio differs by at most
+    `max_aspect_diff` (relative) and which passes `same_drawing` with
+    `max_pixel_diff`. The hash only finds candidates, since crops that differ in
+    a small label can be within a few bits. Candidates are looked up by hash
+    bands: two hashes within `max_distance` bits agree on at least one of
+    `max_distance + 1` bands."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(lambda path: _try_dhash(path, hash_size), image_paths))
+
+    n_bits = hash_size * hash_size
+    n_bands = max_distance + 1
+    groups = []
+    representatives = []
+    band_index = {}
+    for i, image_hash in enumerate(hashes):
+        if image_hash is None:
+            # Unreadable images are never merged; the LLM call reports the error.
+            groups.append([i])
+            representatives.append(None)
+            continue
+        bits, aspect = image_hash
+        bands = _bands(bits, n_bands, n_bits)
+        match = None
+        for candidate in sorted({g for band in bands for g in band_index.get(band, ())}):
+            rep_bits, rep_aspect = representatives[candidate]
+            if (bin(bits ^ rep_bits).count("1") <= max_distance
+                    and abs(aspect - rep_aspect) <= max_aspect_diff * rep_aspect
+                    and same_drawing(image_paths[groups[candidate][0]], image_paths[i], max_pixel_diff)):
+                match = candidate
+                break
+        if match is not None:
+            groups[match].append(i)
+            continue
+        for band in bands:
+            band_index.setdefault(band, []).append(len(groups))
+        representatives.append((bits, aspect))
+        groups.append([i])
+    return groups
@@ -0,0 +1,72 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from image_preprocess import profile_params, encode_job
+
+
+class ImagePrefetcher:
+    """Encodes the images of upcoming work items in a small process pool.
+
+    A feeder thread walks the job list and keeps at most `ahead` encoded images
+    waiting to be used; a slot is freed when a worker takes its image. Images a
+    worker asks for before they were submitted are encoded by the worker itself
+    and skipped by the feeder."""
+
+    def __init__(self, cache, workers=2, ahead=32):
+        self.cache = cache
+        # Spawned rather than forked: the parent already runs the LLM event loop
+        # and worker threads.
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self._slots = threading.Semaphore(ahead)
+        self._pending = {}
+        self._taken = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self, jobs):
+        thread = threading.Thread(target=self._feed, args=(list(jobs),), daemon=True)
+        thread.start()
+        return thread
+
+    def _feed(self, jobs):
+        for image_path, profile in jobs:
+            key = (image_path, profile)
+            with self._lock:
+                if key in self._pending or key in self._taken:
+                    continue
+            if self.cache.contains(image_path, profile_params(profile)):
+                continue
+            self._slots.acquire()
+            with self._lock:
+                if self._closed:
+                    self._slots.release()
+                    return
+                if key in self._taken:
+                    self._slots.release()
+                    continue
+                self._pending[key] = self._executor.submit(encode_job, key)
+
+    def take(self, image_path, profile):
+        """Payload of a prefetched image, waiting for it if it is still being
+        encoded. None if the image was not prefetched."""
+        key = (image_path, profile)
+        with self._lock:
+            future = self._pending.pop(key, None)
+            self._taken.add(key)
+        if future is None:
+            return None
+        self._slots.release()
+        try:
+            return future.result()[2]
+        except Exception as e:
+            print(f"Prefetch of {image_path} failed: {e}")
+            return None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+        # Wake the feeder if it is waiting for a slot.
+        self._slots.release()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,164 @@
+import argparse
+import base64
+import glob
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops
+
+from image_cache import EncodedImageCache, DEFAULT_IMAGE_CACHE_PATH
+
+# Named preprocessing profiles for images sent to the LLMs:
+#   max_side   downscale so that the longer side is at most this many pixels
+#   grayscale  drop colour (molecule crops are black on white)
+#   trim       cut uniform borders, keeping `margin` pixels
+#   format     encoder name from ENCODERS (jpeg, png, webp)
+#   quality    JPEG/WebP quality; max_kb lowers it step by step until the payload fits
+# "original" keeps the old behaviour: PNGs are re-encoded as JPEG, other files are
+# sent unchanged.
+PROFILES = {
+    "original": {},
+    "table": {"max_side": 2048, "trim": True, "quality": 85},
+    "table_small": {"max_side": 1280, "trim": True, "quality": 75, "max_kb": 300},
+    "table_webp": {"max_side": 2048, "trim": True, "format": "webp", "quality": 80},
+    "table_png": {"max_side": 2048, "trim": True, "format": "png"},
+    "molecule": {"max_side": 512, "grayscale": True, "trim": True, "quality": 85},
+    "molecule_png": {"max_side": 512, "grayscale": True, "trim": True, "format": "png"},
+}
+
+MIN_QUALITY = 40
+
+
+def _save_lossy(image_format):
+    def save(image, params):
+        quality = params.get("quality", 85)
+        max_bytes = params["max_kb"] * 1024 if params.get("max_kb") else None
+        while True:
+            buffer = io.BytesIO()
+            image.save(buffer, format=image_format, quality=quality, optimize=True)
+            if max_bytes is None or buffer.tell() <= max_bytes or quality <= MIN_QUALITY:
+                return buffer.getvalue()
+            quality -= 10
+    return save
+
+
+def _save_png(image, params):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+# encoder name -> (MIME type, save(image, params) -> bytes)
+ENCODERS = {
+    "jpeg": ("image/jpeg", _save_lossy("JPEG")),
+    "webp": ("image/webp", _save_lossy("WEBP")),
+    "png": ("image/png", _save_png),
+}
+
+
+def register_encoder(name, mime, save):
+    ENCODERS[name] = (mime, save)
+
+
+def register_profile(name, max_side=None, grayscale=False, trim=False, margin=8, format="jpeg", quality=85,
+                     max_kb=None):
+    PROFILES[name] = {
+        "max_side": max_side,
+        "grayscale": grayscale,
+        "trim": trim,
+        "margin": margin,
+        "format": format,
+        "quality": quality,
+        "max_kb": max_kb
+    }
+
+
+def profile_params(profile):
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown image profile: {profile} (known: {', '.join(PROFILES)})")
+    return {"profile": profile, **PROFILES[profile]}
+
+
+def trim_border(image, margin=8):
+    # The top-left pixel is taken as the background colour.
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    bbox = ImageChops.difference(image, background).getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(left - margin, 0),
+        max(top - margin, 0),
+        min(right + margin, image.width),
+        min(bottom + margin, image.height)
+    ))
+
+
+def preprocess_image(image_path, profile="original"):
+    """Return (encoded bytes, MIME type) for `image_path` under `profile`. The
+    file is read once; its type is taken from the decoded image, not the name."""
+    params = PROFILES[profile]
+    with open(image_path, "rb") as image_file:
+        data = image_file.read()
+    with Image.open(io.BytesIO(data)) as image:
+        if not params:
+            if image.format != "PNG":
+                return data, Image.MIME.get(image.format, "image/jpeg")
+            buffer = io.BytesIO()
+            image.convert("RGB").save(buffer, format="JPEG")
+            return buffer.getvalue(), "image/jpeg"
+
+        image = image.convert("L" if params.get("grayscale") else "RGB")
+        if params.get("trim"):
+            image = trim_border(image, params.get("margin", 8))
+        max_side = params.get("max_side")
+        if max_side and max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        mime, save = ENCODERS[params.get("format", "jpeg")]
+        return save(image, params), mime
+
+
+def encode_data_url(image_path, profile="original"):
+    data, mime = preprocess_image(image_path, profile)
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+def encode_job(job):
+    image_path, profile = job
+    return image_path, profile, encode_data_url(image_path, profile)
+
+
+def materialize(image_paths, profiles, cache, workers=None):
+    """Encode every image under every profile in a process pool and store the
+    payloads in `cache`, so that runs using those profiles only read them."""
+    jobs = [(path, profile) for path in image_paths for profile in profiles]
+    original = 0
+    encoded = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for image_path, profile, payload in executor.map(encode_job, jobs, chunksize=16):
+            cache.put(image_path, profile_params(profile), payload)
+            original += os.path.getsize(image_path)
+            encoded += (len(payload) - payload.index(',') - 1) * 3 // 4
+    return len(jobs), original, encoded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-encode images under named preprocessing profiles')
+    parser.add_argument('--profiles', nargs='+', default=["table"], help=f'Profiles to build ({", ".join(PROFILES)})')
+    parser.add_argument('--dirs', nargs='+', default=["data/img"], help='Image directories (searched recursively)')
+    parser.add_argument('--cache', default=DEFAULT_IMAGE_CACHE_PATH, help='Image cache to store the payloads in')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        profile_params(profile)
+    image_paths = []
+    for directory in args.dirs:
+        for ext in ("png", "jpg", "jpeg", "webp"):
+            image_paths.extend(glob.glob(os.path.join(directory, "**", f"*.{ext}"), recursive=True))
+    image_paths.sort()
+
+    count, original, encoded = materialize(image_paths, args.profiles, EncodedImageCache(0, args.cache), args.workers)
+    print(f"Encoded {count} images ({len(image_paths)} files x {len(args.profiles)} profiles): "
+          f"{original / 1024 / 1024:.1f} MB -> {encoded / 1024 / 1024:.1f} MB")
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "cache/llm_cache.sqlite"
+
+
+def request_key(model_name, mes, temperature, max_tokens, stop=None):
+    # Images are sent inline as base64 data URLs, so hashing the messages also
+    # hashes the image bytes.
+    request = {
+        "model": model_name,
+        "messages": mes,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if stop:
+        request["stop"] = stop
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, read_only=False, max_size_mb=2048, max_age_days=None,
+                 evict_every=500):
+        self.path = path
+        self.read_only = read_only
+        self.max_size = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed)")
+        if not read_only:
+            self.evict()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age and time.time() - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, model_name, response):
+        if self.read_only:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, len(response.encode("utf-8")), now, now)
+            )
+            self.writes += 1
+            evict = self.writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            if self.max_age:
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_size:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_size:
+                    # Drop least recently used entries until 90% of the budget is left.
+                    to_free = total - int(self.max_size * 0.9)
+                    freed = 0
+                    keys = []
+                    for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                        keys.append((key,))
+                        freed += size
+                        if freed >= to_free:
+                            break
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0,
+            "entries": entries,
+            "size_mb": size / 1024 / 1024
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,146 @@
+import json
+import os
+import sys
+import threading
+import time
+
+# USD per 1M (prompt, completion) tokens. Models not listed are reported without cost.
+MODEL_PRICES = {
+    "gpt-4.1-2025-04-14": (2.0, 8.0),
+    "gpt-4.1-mini-2025-04-14": (0.4, 1.6),
+    "gpt-4.1-nano-2025-04-14": (0.1, 0.4),
+}
+
+
+def count_images(mes):
+    images = 0
+    for message in mes:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            images += sum(1 for part in content if part.get("type") == "image_url")
+    return images
+
+
+class UsageTracker:
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.budgets = {}
+        self.totals = {}
+        self.tokens_by_model = {}
+        self.first_start = None
+        self.last_end = None
+        self._lock = threading.Lock()
+
+    def set_budget(self, model_name, tokens):
+        if tokens:
+            self.budgets[model_name] = int(tokens)
+        else:
+            self.budgets.pop(model_name, None)
+
+    def over_budget(self, model_name):
+        budget = self.budgets.get(model_name)
+        return budget is not None and self.tokens_by_model.get(model_name, 0) >= budget
+
+    def record(self, model_name, task, start, end, prompt_tokens=0, completion_tokens=0, images=0, retries=0,
+               error=None, cached=False, estimated=False, coalesced=False):
+        record = {
+            "model": model_name,
+            "task": task or "default",
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "images": images,
+            "latency": end - start,
+            "retries": retries,
+            "error": error,
+            "cached": cached,
+            "coalesced": coalesced,
+            "estimated": estimated
+        }
+        with self._lock:
+            self.first_start = start if self.first_start is None else min(self.first_start, start)
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+            self.tokens_by_model[model_name] = self.tokens_by_model.get(model_name, 0) + prompt_tokens + completion_tokens
+            total = self.totals.setdefault((model_name, record["task"]), {
+                "requests": 0, "cached": 0, "coalesced": 0, "estimated": 0, "errors": 0, "retries": 0, "images": 0,
+                "prompt_tokens": 0, "completion_tokens": 0, "estimated_prompt_tokens": 0,
+                "estimated_completion_tokens": 0, "latency_sum": 0.0, "latency_max": 0.0
+            })
+            total["requests"] += 1
+            total["cached"] += int(cached)
+            total["coalesced"] += int(coalesced)
+            total["estimated"] += int(estimated)
+            total["errors"] += int(error is not None)
+            total["retries"] += retries
+            total["images"] += images
+            # Estimates (no usage block from the endpoint) are kept apart from
+            # measured tokens; they still count towards budgets.
+            prefix = "estimated_" if estimated else ""
+            total[prefix + "prompt_tokens"] += prompt_tokens
+            total[prefix + "completion_tokens"] += completion_tokens
+            if not cached and not coalesced:
+                total["latency_sum"] += record["latency"]
+                total["latency_max"] = max(total["latency_max"], record["latency"])
+            if self.log_file:
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def summary(self):
+        with self._lock:
+            wall = (self.last_end - self.first_start) if self.first_start is not None else 0
+            rows = []
+            all_requests = 0
+            all_tokens = 0
+            all_estimated = 0
+            all_cost = 0.0
+            all_estimated_cost = 0.0
+            for (model_name, task), total in sorted(self.totals.items()):
+                sent = total["requests"] - total["cached"] - total["coalesced"]
+                tokens = total["prompt_tokens"] + total["completion_tokens"]
+                estimated = total["estimated_prompt_tokens"] + total["estimated_completion_tokens"]
+                price = MODEL_PRICES.get(model_name)
+                cost = estimated_cost = None
+                if price is not None:
+                    cost = (total["prompt_tokens"] * price[0] + total["completion_tokens"] * price[1]) / 1e6
+                    estimated_cost = (total["estimated_prompt_tokens"] * price[0]
+                                      + total["estimated_completion_tokens"] * price[1]) / 1e6
+                    all_cost += cost
+                    all_estimated_cost += estimated_cost
+                rows.append({
+                    "model": model_name,
+                    "task": task,
+                    **{k: v for k, v in total.items() if k not in ("latency_sum", "latency_max")},
+                    "avg_latency": total["latency_sum"] / sent if sent > 0 else 0,
+                    "max_latency": total["latency_max"],
+                    "cost_usd": cost,
+                    "estimated_cost_usd": estimated_cost
+                })
+                all_requests += total["requests"]
+                all_tokens += tokens
+                all_estimated += estimated
+            return {
+                "script": os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None,
+                "wall_time": wall,
+                "requests": all_requests,
+                "tokens": all_tokens,
+                "estimated_tokens": all_estimated,
+                "requests_per_second": all_requests / wall if wall > 0 else 0,
+                "tokens_per_second": (all_tokens + all_estimated) / wall if wall > 0 else 0,
+                "cost_usd": all_cost,
+                "estimated_cost_usd": all_estimated_cost,
+                "by_model_task": rows
+            }
+
+    def write_summary(self, output_dir):
+        if not self.totals:
+            return None
+        summary = self.summary()
+        os.makedirs(output_dir, exist_ok=True)
+        script = os.path.splitext(summary["script"] or "run")[0]
+        path = os.path.join(output_dir, f"usage_{script}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"LLM usage: {summary['requests']} requests, {summary['tokens']} tokens "
+              f"(+{summary['estimated_tokens']} estimated), "
+              f"{summary['requests_per_second']:.2f} req/s, {summary['tokens_per_second']:.0f} tok/s, "
+              f"${summary['cost_usd']:.2f} (+${summary['estimated_cost_usd']:.2f} estimated, priced models) -> {path}")
+        return path
@@ -0,0 +1,189 @@
+import base64
+import io
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+DEFAULT_STATE_PATH = "cache/rate_limits.sqlite"
+
+# Tokens charged for an image part whose size cannot be read from its data URL.
+IMAGE_TOKENS = 1000
+# Base64 characters of a data URL decoded to read the image size from its header.
+IMAGE_HEADER_CHARS = 65536
+
+
+def estimate_text_tokens(text):
+    """About 4 characters per token for ASCII text and one per character for
+    other text (mostly Chinese here)."""
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return (len(text) - non_ascii) // 4 + non_ascii
+
+
+def _image_size(url):
+    if not url.startswith("data:"):
+        return None
+    data = url.partition(",")[2][:IMAGE_HEADER_CHARS]
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(data[:len(data) // 4 * 4]))) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+def estimate_image_tokens(part):
+    """Tokens of an image part, following OpenAI's tiling: the image is fitted
+    into 2048x2048, its short side scaled down to 768, and every 512px tile
+    costs 170 tokens on top of a base of 85."""
+    image_url = part.get("image_url") or {}
+    if image_url.get("detail") == "low":
+        return 85
+    size = _image_size(image_url.get("url", ""))
+    if not size or not all(size):
+        return IMAGE_TOKENS
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+def estimate_tokens(mes, max_tokens=0):
+    tokens = max_tokens + 3
+    for message in mes:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            tokens += estimate_text_tokens(content) + 4
+            continue
+        tokens += 4
+        for part in content:
+            if part.get("type") == "text":
+                tokens += estimate_text_tokens(part.get("text", ""))
+            else:
+                tokens += estimate_image_tokens(part)
+    return tokens
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute token buckets keyed by endpoint
+    or model name. Bucket state lives in an SQLite file so that all processes on
+    one host draw from the same quota."""
+
+    def __init__(self, path=DEFAULT_STATE_PATH, burst_seconds=10):
+        self.path = path
+        self.burst_seconds = burst_seconds
+        self.limits = {}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def set_limit(self, name, rpm=None, tpm=None):
+        limit = {}
+        if rpm:
+            limit["rpm"] = float(rpm)
+        if tpm:
+            limit["tpm"] = float(tpm)
+        if limit:
+            self.limits[name] = limit
+        else:
+            self.limits.pop(name, None)
+
+    def load_limits(self, config):
+        for name, limit in config.items():
+            self.set_limit(name, rpm=limit.get("rpm"), tpm=limit.get("tpm"))
+
+    def _connect(self):
+        if self._conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        return self._conn
+
+    def _buckets(self, names, tokens):
+        buckets = []
+        for name in names:
+            limit = self.limits.get(name)
+            if not limit:
+                continue
+            if "rpm" in limit:
+                buckets.append((f"{name}:rpm", limit["rpm"], 1))
+            if "tpm" in limit:
+                buckets.append((f"{name}:tpm", limit["tpm"], tokens))
+        return buckets
+
+    def _refill(self, conn, bucket, rate, now):
+        capacity = max(rate * self.burst_seconds / 60, 1)
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (bucket,)).fetchone()
+        if row is None:
+            return capacity, capacity
+        return min(capacity, row[0] + (now - row[1]) * rate / 60), capacity
+
+    def try_acquire(self, names, tokens=0):
+        """Take one request and `tokens` tokens from every bucket that applies.
+        Returns 0 on success, otherwise the number of seconds to wait before
+        trying again (nothing is taken in that case)."""
+        buckets = self._buckets(names, tokens)
+        if not buckets:
+            return 0
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                levels = []
+                wait = 0
+                for bucket, rate, cost in buckets:
+                    level, capacity = self._refill(conn, bucket, rate, now)
+                    # A request larger than the whole bucket goes through once it is full.
+                    cost = min(cost, capacity)
+                    if level < cost:
+                        wait = max(wait, (cost - level) * 60 / rate)
+                    levels.append((bucket, level, cost))
+                for bucket, level, cost in levels:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                        (bucket, level if wait > 0 else level - cost, now)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def adjust(self, names, tokens):
+        """Charge (positive) or refund (negative) tokens once the real usage of a
+        request is known."""
+        buckets = [b for b in self._buckets(names, tokens) if b[0].endswith(":tpm")]
+        if not buckets or tokens == 0:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                for bucket, rate, cost in buckets:
+                    level, capacity = self._refill(conn, bucket, rate, now)
+                    conn.execute(
+                        "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                        (bucket, min(level - tokens, capacity), now)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+
+def load_limits_from_env(limiter):
+    # e.g. CHEMTABLE_RATE_LIMITS='{"YOUR_ALTERNATIVE_API_ENDPOINT": {"rpm": 600, "tpm": 400000}}'
+    config = os.environ.get("CHEMTABLE_RATE_LIMITS")
+    if not config:
+        return
+    if os.path.exists(config):
+        with open(config, 'r', encoding='utf-8') as f:
+            config = f.read()
+    limiter.load_limits(json.loads(config))
@@ -210,6 +210,101 @@ Please answer the question based on the html content of the table and the image
 ```json
 """
 
+qa_prompt_packed_html = """
+## instruction
+Please answer each of the questions based on the html content of the table.
+
+
+## Table
+{Table_html}
+
+
+## Format:
+```json
+{
+    "answers": [
+        {
+            "id": 1,
+            "chain_of_thought": "your chain of thought about how you get the final result of question 1.",
+            "answer": "answer to question 1"
+        }
+    ]
+}
+```
+Answer every question, in order, with the question number as "id".
+
+
+## Questions
+{Questions}
+
+
+## Answer:
+```json
+"""
+
+
+qa_prompt_packed_image = """
+## instruction
+Please answer each of the questions based on the image of the table.
+
+
+## Format:
+```json
+{
+    "answers": [
+        {
+            "id": 1,
+            "chain_of_thought": "your chain of thought about how you get the final result of question 1.",
+            "answer": "answer to question 1"
+        }
+    ]
+}
+```
+Answer every question, in order, with the question number as "id".
+
+
+## Questions
+{Questions}
+
+
+## Answer:
+```json
+"""
+
+
+qa_prompt_packed_hybrid = """
+## instruction
+Please answer each of the questions based on the html content of the table and the image of the table.
+
+
+## Table
+{Table_html}
+
+
+## Format:
+```json
+{
+    "answers": [
+        {
+            "id": 1,
+            "chain_of_thought": "your chain of thought about how you get the final result of question 1.",
+            "answer": "answer to question 1"
+        }
+    ]
+}
+```
+Answer every question, in order, with the question number as "id".
+
+
+## Questions
+{Questions}
+
+
+## Answer:
+```json
+"""
+
+
 qa_answer_eval = """
 ## instruction
 Please evaluate the answer based on the question and the answer. If the answer is correct, please return "correct". If the answer is incorrect, please return "incorrect".
@@ -335,4 +430,33 @@ You are an expert in the field of question answering. Now I have an image-based
 
 ## Answer
 ```json
-"""
\ No newline at end of file
+"""
+
+repair_json_prompt = """
+## instruction
+The text below was meant to be a single JSON object but cannot be parsed. Re-format it into valid JSON.
+Keep the keys and values from the text and do not change their content. If the text has no keys, use "chain_of_thought" for the reasoning and "answer" for the final answer.
+
+
+## Text
+{Text}
+
+
+## Answer
+```json
+"""
+
+
+repair_html_prompt = """
+## instruction
+The text below was meant to contain an HTML table but cannot be parsed. Re-format it into a single valid HTML table.
+Use only five tags: <table>, <thead>, <tr>, <td>, and <tbody>. Keep the cell contents exactly as they are, including [#smiles#] markers.
+
+
+## Text
+{Text}
+
+
+## Answer
+```html
+"""
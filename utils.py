@@ -1,17 +1,25 @@
-import imghdr
+import atexit
+import threading
 import json
 import os
 import re
-import base64
-import io
 import warnings
-from template import qa_answer_eval
-from LLM import call_LLM
+from template import qa_answer_eval, repair_json_prompt, repair_html_prompt
+from template import qa_prompt_packed_image, qa_prompt_packed_html, qa_prompt_packed_hybrid
+from LLM import call_LLM, LLMUnavailable, LLMCallError, IN_WORKER_PROCESS
+from llm_cache import ResponseCache, request_key
+from image_cache import EncodedImageCache, DEFAULT_IMAGE_CACHE_PATH
+from image_preprocess import profile_params, encode_data_url
+from image_prefetch import ImagePrefetcher
 
 from bs4 import BeautifulSoup
 from rdkit import Chem
 from rdkit.Chem import Draw
-from PIL import Image
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def remove_special_formats(input_str):
@@ -84,9 +92,26 @@ def generate_html_table(cells):
     return html_table
 
 
-def convert_json_tables_to_html(file_path):
+def load_json_file(file_path):
+    """Parse a JSON file, with orjson when it is installed."""
+    if orjson is not None:
+        with open(file_path, 'rb') as f:
+            content = f.read()
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN/Infinity and integers beyond 64 bits, which json accepts.
+            return json.loads(content)
     with open(file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+        return json.load(f)
+
+
+def convert_json_tables_to_html(file_path):
+    return convert_tables_to_html(load_json_file(file_path))
+
+
+def convert_tables_to_html(data):
+    """HTML of every table of an already parsed table JSON document."""
     html_list = []
     for table in data["data"]["tables"]:
         table_cells = []
@@ -202,29 +227,90 @@ def create_dict_from_files(files, source_path, folder):
     return result_dict
 
 
-def encode_image(image_path):
-    with Image.open(image_path) as image:
-        if image.format == "PNG":
-            image = image.convert("RGB")
-            buffer = io.BytesIO()
-            image.save(buffer, format="JPEG")
-            buffer.seek(0)
-            encoded_image = base64.b64encode(buffer.read()).decode('utf-8')
-        else:
-            with open(image_path, "rb") as image_file:
-                encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-    return encoded_image
+# Encoded images are kept in memory (CHEMTABLE_IMAGE_CACHE_MEMORY_MB) and, with
+# CHEMTABLE_IMAGE_CACHE=1 or a path to an SQLite file, on disk for later runs.
+_image_cache_path = os.environ.get("CHEMTABLE_IMAGE_CACHE")
+if IN_WORKER_PROCESS:
+    # Spawned workers encode through image_preprocess and never use this cache.
+    _image_cache_path = None
+elif _image_cache_path == "1":
+    _image_cache_path = DEFAULT_IMAGE_CACHE_PATH
+image_cache = EncodedImageCache(float(os.environ.get("CHEMTABLE_IMAGE_CACHE_MEMORY_MB", 256)), _image_cache_path or None)
+
+
+# Preprocessing profiles (see image_preprocess.PROFILES) for table images and for
+# molecule crops. "original" sends the images as before.
+IMAGE_PROFILE = os.environ.get("CHEMTABLE_IMAGE_PROFILE", "original")
+MOLECULE_IMAGE_PROFILE = os.environ.get("CHEMTABLE_MOLECULE_IMAGE_PROFILE", "original")
+
+# profile -> [images, original bytes, sent bytes]
+_image_bytes = {}
+_image_bytes_lock = threading.Lock()
+
+
+# Worker processes for prefetch_images; 0 disables prefetching.
+PREFETCH_WORKERS = int(os.environ.get("CHEMTABLE_IMAGE_PREFETCH_WORKERS", 2))
+_prefetcher = None
+
+
+def prefetch_images(image_paths, profile=None, ahead=32):
+    """Start encoding the images of upcoming work items in the background, in
+    the order they will be used, so prompts are ready when a worker gets there."""
+    global _prefetcher
+    if PREFETCH_WORKERS <= 0:
+        return
+    if _prefetcher is None:
+        _prefetcher = ImagePrefetcher(image_cache, PREFETCH_WORKERS, ahead)
+        atexit.register(_prefetcher.close)
+    profile = profile or IMAGE_PROFILE
+    _prefetcher.start((path, profile) for path in image_paths if os.path.exists(path))
+
+
+def _encode(image_path, profile):
+    if _prefetcher is not None:
+        payload = _prefetcher.take(image_path, profile)
+        if payload is not None:
+            return payload
+    return encode_data_url(image_path, profile)
 
 
-def get_image_type(image_path):
-    image_type = imghdr.what(image_path)
-    return image_type if image_type else "jpeg"
+def image_data_url(image_path, profile=None):
+    """`data:` URL for `image_path` under `profile`, labelled with the MIME type of
+    the bytes actually sent."""
+    profile = profile or IMAGE_PROFILE
+    data_url = image_cache.get(image_path, profile_params(profile), lambda path: _encode(path, profile))
+    with _image_bytes_lock:
+        counts = _image_bytes.setdefault(profile, [0, 0, 0])
+        counts[0] += 1
+        counts[1] += os.path.getsize(image_path)
+        counts[2] += (len(data_url) - data_url.index(",") - 1) * 3 // 4
+    return data_url
 
 
-def create_prompt(mes, image_path=None):
+def load_image(image_path, profile=None):
+    """Return (base64 payload, MIME type) for `image_path` under `profile`."""
+    header, payload = image_data_url(image_path, profile).split(",", 1)
+    return payload, header[len("data:"):-len(";base64")]
+
+
+def encode_image(image_path, profile=None):
+    return load_image(image_path, profile)[0]
+
+
+def _print_image_stats():
+    for profile, (images, original, sent) in sorted(_image_bytes.items()):
+        saved = 1 - sent / original if original > 0 else 0
+        print(f"Images ({profile}): {images} sent, {original / 1024 / 1024:.1f} MB -> {sent / 1024 / 1024:.1f} MB "
+              f"({saved:.0%} saved)")
+
+
+if not IN_WORKER_PROCESS:
+    atexit.register(_print_image_stats)
+
+
+def create_prompt(mes, image_path=None, profile=None):
     if not image_path:
         return create_prompt_text(mes)
-    base64_image = encode_image(image_path)
     return [{
         "role": "user",
         "content": [
@@ -232,7 +318,7 @@ def create_prompt(mes, image_path=None):
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/{get_image_type(image_path)};base64,{base64_image}"
+                    "url": image_data_url(image_path, profile)
                 }
             }
         ]
@@ -247,7 +333,55 @@ def create_prompt_text(mes):
         ]
     }]
 
-def extract_HTML(text):
+# Small text-only model that re-formats responses which do not parse.
+REPAIR_MODEL = "gpt-4.1-nano-2025-04-14"
+
+# Repairs are always cached (unlike other calls, which need CHEMTABLE_LLM_CACHE),
+# so re-scoring a run does not pay for the same repairs again.
+# CHEMTABLE_REPAIR_CACHE sets the file; "0" disables it.
+REPAIR_CACHE_PATH = os.environ.get("CHEMTABLE_REPAIR_CACHE", "cache/repair_cache.sqlite")
+_repair_cache = None
+_repair_cache_lock = threading.Lock()
+
+
+def _get_repair_cache():
+    global _repair_cache
+    if REPAIR_CACHE_PATH in ("", "0"):
+        return None
+    with _repair_cache_lock:
+        if _repair_cache is None:
+            _repair_cache = ResponseCache(REPAIR_CACHE_PATH, max_size_mb=256)
+        return _repair_cache
+
+
+def repair_output(text, kind):
+    prompt = (repair_json_prompt if kind == "json" else repair_html_prompt).replace("{Text}", text)
+    mes = create_prompt_text(prompt)
+    cache = _get_repair_cache()
+    key = request_key(REPAIR_MODEL, mes, 0, None)
+    if cache is not None:
+        repaired = cache.get(key)
+        if repaired is not None:
+            return repaired
+    try:
+        repaired = call_LLM(mes, model_name=REPAIR_MODEL, task=f"repair_{kind}")
+    except LLMCallError as e:
+        print(f"Repair of {kind} output failed: {e}")
+        return None
+    if cache is not None and repaired is not None:
+        cache.put(key, REPAIR_MODEL, repaired)
+    return repaired
+
+def extract_HTML(text, repair=False):
+    try:
+        return _parse_HTML(text)
+    except Exception:
+        repaired = repair_output(text, "html") if repair and text else None
+        if repaired is None:
+            raise
+        return _parse_HTML(repaired)
+
+def _parse_HTML(text):
     start_index = text.find('```html')
     end_index = text.rfind('</table>')
     if start_index != -1 and end_index != -1:
@@ -305,7 +439,16 @@ class ResultEvaluator:
     def is_already_eval(self, index):
         return index in self.success_set
 
-def extract_json(text):
+def extract_json(text, repair=False):
+    try:
+        return _parse_json(text)
+    except Exception:
+        repaired = repair_output(text, "json") if repair and text else None
+        if repaired is None:
+            raise
+        return _parse_json(repaired)
+
+def _parse_json(text):
     json_pattern = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
     match = json_pattern.search(text)
     
@@ -417,7 +560,7 @@ def evaluate_answer(question, ground_truth, model_answer):
     prompt = qa_answer_eval.replace("{Question}", question).replace("{Answer}", ground_truth).replace("{Model_Answer}", model_answer)
     
     try:
-        eval_response = call_LLM([{"role": "user", "content": prompt}], model_name="gpt-4.1-nano-2025-04-14")
+        eval_response = call_LLM([{"role": "user", "content": prompt}], model_name="gpt-4.1-nano-2025-04-14", task="judge")
         
         try:
             eval_result = extract_json(eval_response)
@@ -425,10 +568,82 @@ def evaluate_answer(question, ground_truth, model_answer):
         except json.JSONDecodeError:
             print(f"Failed to parse evaluation result: {eval_response}")
             return "unknown"
+    except LLMUnavailable:
+        raise
     except Exception as e:
         print(f"Error evaluating answer: {e}")
         return "unknown"
 
+# Batched QA: with CHEMTABLE_QA_PACK=<n> (n >= 2) the QA scripts ask up to n
+# questions about the same table image in one request. 0 asks one at a time.
+PACK_SIZE = int(os.environ.get("CHEMTABLE_QA_PACK", 0))
+
+def group_by_image(qa_pairs, size=None):
+    size = PACK_SIZE if size is None else size
+    if size < 2:
+        return [[qa_pair] for qa_pair in qa_pairs]
+    groups = {}
+    for qa_pair in qa_pairs:
+        groups.setdefault(qa_pair["id"], []).append(qa_pair)
+    return [group[i:i + size] for group in groups.values() for i in range(0, len(group), size)]
+
+def ask_packed_questions(questions, model_name, image_path=None, table_html=None):
+    """Ask several questions about one table in a single request.
+
+    Returns one answer per question, as the JSON text a single-question request
+    would have produced, so callers parse it the same way. Questions without a
+    usable answer map to None and should be asked on their own."""
+    if len(questions) < 2 or (image_path is None and table_html is None):
+        return [None] * len(questions)
+    if table_html is None:
+        template = qa_prompt_packed_image
+    elif image_path is None:
+        template = qa_prompt_packed_html
+    else:
+        template = qa_prompt_packed_hybrid
+    numbered = "\n".join(f"{i}. {question}" for i, question in enumerate(questions, 1))
+    try:
+        prompt = create_prompt(template.replace("{Table_html}", table_html or "").replace("{Questions}", numbered),
+                               image_path)
+        response = call_LLM(prompt, model_name=model_name, task="qa_json_packed")
+        items = extract_json(response, repair=True).get("answers", [])
+    except LLMUnavailable as e:
+        if not isinstance(e, LLMCallError):
+            raise
+        print(f"Packed request failed, asking questions one by one: {e}")
+        return [None] * len(questions)
+    except Exception as e:
+        print(f"Failed to get packed answers, asking questions one by one: {e}")
+        return [None] * len(questions)
+
+    answers = [None] * len(questions)
+    for item in items:
+        try:
+            index = int(item["id"]) - 1
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 <= index < len(questions) and "answer" in item:
+            answers[index] = json.dumps({
+                "chain_of_thought": item.get("chain_of_thought", ""),
+                "answer": item["answer"]
+            }, ensure_ascii=False)
+    return answers
+
+def answer_packed_group(group, model_name, answer_one, image_path=None, table_html=None):
+    """Answer the questions of `group` (all about one table) with one packed
+    request, then call `answer_one(qa_pair, packed_answer)` for every question;
+    `packed_answer` is None for questions that have to be asked on their own.
+
+    Returns the results of `answer_one`, or None if the endpoint is unavailable
+    and the group was skipped."""
+    try:
+        answers = ask_packed_questions([qa_pair.get("question", "") for qa_pair in group], model_name, image_path,
+                                       table_html)
+    except LLMUnavailable as e:
+        print(f"Skipping questions on {group[0].get('id')}: {e}")
+        return None
+    return [answer_one(qa_pair, answer) for qa_pair, answer in zip(group, answers)]
+
 def is_valid_smiles(smiles):
     try:
         mol = Chem.MolFromSmiles(smiles)